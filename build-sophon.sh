@@ -14,6 +14,8 @@ NUITKA_CACHE_DIR=./.cache uv run nuitka \
 --standalone \
 --python-flag=isolated \
 --include-data-files=./hpatchz=./hpatchz \
+--include-package=hdiffpatch \
+--include-module=xxhash \
 --output-filename=sophon-server \
 --output-dir=./build \
 --assume-yes-for-downloads \
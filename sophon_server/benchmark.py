@@ -0,0 +1,628 @@
+# Benchmarks for the sophon downloader using a local HTTP stand-in
+# SPDX-License-Identifier: MIT
+
+"""
+	Usage
+	-----
+	python benchmark.py engine [--requests N] [--size BYTES] [--workers N]
+		Compares one `pycurl.Curl` per request (previous implementation)
+		against the shared `DownloadEngine`. Reports requests/s.
+
+	python benchmark.py e2e [install|update|repair|repair-offline ...] [--files N] [--min-size BYTES]
+			[--max-size BYTES] [--chunk-size BYTES] [--latency SECONDS] [--error-rate P]
+		Runs `perform_install`, `perform_update` and `perform_repair` end to end against a
+		synthetic game served by a fake API/CDN. Reports wall time, bytes/s, files/s,
+		peak RSS and bytes written (where psutil supports it).
+		"repair-offline" verifies against a `pkg_version` file instead of the manifest.
+		Update patches are created with `hdiffz` (HDiffPatch) if available. Without it,
+		modified files get no patches and change their size, thus they are downloaded by chunks.
+
+	All servers bind to 127.0.0.1 on a random port. No external network access.
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import pathlib
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+import pycurl
+import zstandard
+
+import manifest_pb2 # generated
+import manifest_ldiff_pb2 # generated
+import sophon_api
+from models import InstallRequest, RepairRequest, UpdateRequest, TaskStatus
+import tasks
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+
+# ------------------- HTTP stand-in
+
+class StandInHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # keep-alive
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_body(self, body: bytes, code: int = 200, content_type: str = "application/octet-stream") -> int:
+		"""
+		Returns the number of bytes sent
+		"""
+		# Single byte ranges as requested by `_download_file_resume`
+		match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+		if match and code == 200:
+			first = int(match.group(1))
+			last = int(match.group(2)) if match.group(2) else len(body) - 1
+			if first >= len(body):
+				self.send_empty(416)
+				return 0
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {first}-{last}/{len(body)}")
+			body = body[first:last + 1]
+		else:
+			self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		return len(body)
+
+	def send_empty(self, code: int):
+		self.send_response(code)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def do_GET(self):
+		path = self.path.split("?")[0]
+		if path.startswith("/blob/"):
+			return self.send_body(self.server.get_blob(int(path[len("/blob/"):])))
+		self.send_empty(404)
+
+
+class StandInServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, handler = StandInHandler):
+		super().__init__(("127.0.0.1", 0), handler)
+		self._blobs = {}
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+
+	@property
+	def base_url(self) -> str:
+		return f"http://127.0.0.1:{self.server_port}"
+
+	def get_blob(self, size: int) -> bytes:
+		blob = self._blobs.get(size)
+		if blob is None:
+			blob = self._blobs[size] = bytes(size)
+		return blob
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+
+# ------------------- Engine benchmark
+
+def _fetch_single_handle(url: str):
+	received = 0
+	def on_data(data: bytes):
+		nonlocal received
+		received += len(data)
+
+	c = pycurl.Curl()
+	c.setopt(c.URL, url)
+	c.setopt(c.FAILONERROR, True)
+	c.setopt(c.WRITEFUNCTION, on_data)
+	c.perform()
+	c.close()
+	return received
+
+def _fetch_engine(url: str):
+	received = 0
+	def on_data(data: bytes):
+		nonlocal received
+		received += len(data)
+
+	sophon_api.get_download_engine().fetch(url, on_data).raise_for_error()
+	return received
+
+def _run_requests(fetch, url: str, count: int, workers: int) -> float:
+	"""
+	Returns the elapsed wall time in seconds
+	"""
+	t_start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [executor.submit(fetch, url) for _ in range(count)]
+		for future in concurrent.futures.as_completed(futures):
+			future.result()
+	return time.perf_counter() - t_start
+
+def bench_engine(args):
+	server = StandInServer()
+	url = f"{server.base_url}/blob/{args.size}"
+	try:
+		print(f"{args.requests} requests of {args.size} bytes, {args.workers} workers")
+		for name, fetch in [("pycurl.Curl per request", _fetch_single_handle),
+				("DownloadEngine", _fetch_engine)]:
+			_run_requests(fetch, url, args.workers, args.workers) # warm-up
+			elapsed = _run_requests(fetch, url, args.requests, args.workers)
+			mib_s = sophon_api.bytes_to_MiB(args.requests * args.size / elapsed)
+			print(f"{name:<25} {args.requests / elapsed:9.1f} req/s {mib_s:9.1f} MiB/s")
+	finally:
+		server.stop()
+
+
+# ------------------- Synthetic game
+
+OLD_VERSION = "1.0.0"
+NEW_VERSION = "1.1.0"
+DATA_DIR = "GenshinImpact_Data"
+CONFIG_INI = "[General]\r\nchannel=1\r\ncps=mihoyo\r\ngame_version={}\r\nsdk_version=\r\nsub_channel=0\r\n"
+
+def _md5(data: bytes) -> str:
+	return hashlib.md5(data).hexdigest()
+
+def find_hdiffz() -> pathlib.Path | None:
+	path = sophon_api.HPATCHZ_APP.with_name("hdiffz")
+	if path.is_file():
+		return path
+	which = shutil.which("hdiffz")
+	return pathlib.Path(which) if which else None
+
+
+class SyntheticGame:
+	"""
+	Two versions of a fake "hk4e" installation plus everything the CDN serves:
+	chunk files, ldiff files and the zstd-compressed manifests.
+	File contents are derived from the seed, thus nothing is kept in memory.
+
+	Of the files, ~1/8 are added, ~1/8 removed and ~1/4 modified by the update.
+	File sizes follow a log-uniform distribution in [min_size, max_size].
+	Without `hdiffz`, every modified file changes its size: the updater only replaces
+	unpatched files whose size differs.
+	"""
+	PATCHES_PER_LDIFF = 4
+
+	def __init__(self, root: pathlib.Path, files: int, min_size: int, max_size: int,
+			chunk_size: int, seed: int = 1):
+		self.root = root
+		self.chunk_size = chunk_size
+		self.seed = seed
+		self.hdiffz = find_hdiffz()
+		rnd = random.Random(seed)
+
+		# name -> (size in old version or None, size in new version or None)
+		self.files: dict[str, tuple[int | None, int | None]] = {}
+		self.modified: set[str] = set()
+		for i in range(files):
+			size = int(min_size * (max_size / min_size) ** rnd.random())
+			name = f"{DATA_DIR}/StreamingAssets/{i // 100:02d}/blk{i:05d}.blk"
+			kind = rnd.random()
+			if kind < 1 / 8: # added
+				self.files[name] = (None, size)
+			elif kind < 2 / 8: # removed
+				self.files[name] = (size, None)
+			elif kind < 4 / 8: # modified
+				new_size = size + rnd.randint(-size // 8, size // 8)
+				if new_size == size and not self.hdiffz:
+					new_size += 1
+				self.files[name] = (size, new_size)
+				self.modified.add(name)
+			else:
+				self.files[name] = (size, size)
+		self.files["GenshinImpact.exe"] = (64 * 1024, 64 * 1024)
+		self.files[f"{DATA_DIR}/globalgamemanagers"] = (4096, 4096 if self.hdiffz else 4096 + 64)
+		self.modified.add(f"{DATA_DIR}/globalgamemanagers")
+
+		self.cdn = root / "cdn"
+		for subdir in ["chunks", "diffs", "manifests"]:
+			(self.cdn / subdir).mkdir(parents=True, exist_ok=True)
+		self.download_size = 0
+		self._build_manifest()
+		self._build_diff_manifest()
+
+	def file_data(self, name: str, new: bool) -> bytes:
+		old_size, new_size = self.files[name]
+		if name.endswith("globalgamemanagers"):
+			ver = (NEW_VERSION if new else OLD_VERSION).encode()
+			data = b"\0" * 100 + b"\0" + ver + b"_1_1\0"
+			return data + b"\0" * ((new_size if new else old_size) - len(data))
+
+		rnd = random.Random(f"{self.seed}:{name}")
+		data = bytearray(rnd.randbytes(old_size or new_size))
+		# Roughly 2:1 compressible
+		for i in range(0, len(data), 8192):
+			data[i:i + 4096] = bytes(len(data[i:i + 4096]))
+		if new and name in self.modified:
+			rnd = random.Random(f"{self.seed}:{name}:new")
+			for i in range(rnd.randrange(4096), len(data), 65536):
+				data[i:i + 64] = rnd.randbytes(len(data[i:i + 64]))
+			data = data[:new_size] + rnd.randbytes(max(0, new_size - len(data)))
+		return bytes(data)
+
+	def _build_manifest(self):
+		cctx = zstandard.ZstdCompressor()
+		manifest = manifest_pb2.Manifest()
+		for name, (_, size) in sorted(self.files.items()):
+			if size is None:
+				continue
+			data = self.file_data(name, True)
+			v = manifest.files.add()
+			v.filename = name
+			v.size = size
+			v.md5 = _md5(data)
+			for offset in range(0, size, self.chunk_size):
+				part = data[offset:offset + self.chunk_size]
+				compressed = cctx.compress(part)
+				chunk = v.chunks.add()
+				chunk.chunk_id = f"{_md5(part)}_{_md5(compressed)[:16]}"
+				chunk.md5 = _md5(part)
+				chunk.offset = offset
+				chunk.compressed_size = len(compressed)
+				chunk.uncompressed_size = len(part)
+				if xxhash:
+					chunk.xxhash = xxhash.xxh64_intdigest(compressed)
+				(self.cdn / "chunks" / chunk.chunk_id).write_bytes(compressed)
+				self.download_size += len(compressed)
+		(self.cdn / "manifests" / "manifest_game").write_bytes(cctx.compress(manifest.SerializeToString()))
+
+	def _build_diff_manifest(self):
+		hdiffz = self.hdiffz
+		if not hdiffz:
+			print("hdiffz not found. Modified files will be downloaded by chunks.")
+
+		manifest = manifest_ldiff_pb2.DiffManifest()
+		pending = [] # (PatchInfo, patch data)
+		workdir = self.root / "hdiffz"
+		workdir.mkdir(exist_ok=True)
+
+		def flush():
+			blob = b"".join(patch for _, patch in pending)
+			patch_id = _md5(blob)
+			offset = 0
+			for info, patch in pending:
+				info.patch_id = patch_id
+				info.patch_size = len(blob)
+				info.patch_offset = offset
+				info.patch_length = len(patch)
+				offset += len(patch)
+			(self.cdn / "diffs" / patch_id).write_bytes(blob)
+			pending.clear()
+
+		for name, (old_size, new_size) in sorted(self.files.items()):
+			if new_size is None:
+				continue
+			new_data = self.file_data(name, True)
+			v = manifest.files.add()
+			v.filename = name
+			v.size = new_size
+			v.hash = _md5(new_data)
+			if old_size is None:
+				continue # new file: no patches
+
+			old_data = self.file_data(name, False)
+			if old_data == new_data:
+				continue # not modified
+			if not hdiffz:
+				continue
+
+			(workdir / "old").write_bytes(old_data)
+			(workdir / "new").write_bytes(new_data)
+			subprocess.run([hdiffz, "-f", "-c-zstd", workdir / "old", workdir / "new", workdir / "diff"],
+				check=True, stdout=subprocess.DEVNULL)
+			patch = v.patches.add()
+			patch.key = OLD_VERSION
+			patch.info.tag = OLD_VERSION
+			patch.info.original_name = name
+			patch.info.original_size = old_size
+			patch.info.original_hash = _md5(old_data)
+			pending.append((patch.info, (workdir / "diff").read_bytes()))
+			if len(pending) == self.PATCHES_PER_LDIFF:
+				flush()
+		if pending:
+			flush()
+		shutil.rmtree(workdir)
+
+		deleted = manifest.files_delete.add()
+		deleted.key = OLD_VERSION
+		for name, (old_size, new_size) in sorted(self.files.items()):
+			if old_size is not None and new_size is None:
+				entry = deleted.info.list.add()
+				entry.filename = name
+				entry.size = old_size
+				entry.hash = _md5(self.file_data(name, False))
+
+		cctx = zstandard.ZstdCompressor()
+		(self.cdn / "manifests" / "manifest_diff").write_bytes(cctx.compress(manifest.SerializeToString()))
+
+	def write_version(self, gamedir: pathlib.Path, new: bool):
+		for name, sizes in self.files.items():
+			if sizes[1 if new else 0] is None:
+				continue
+			path = gamedir / name
+			path.parent.mkdir(parents=True, exist_ok=True)
+			path.write_bytes(self.file_data(name, new))
+		(gamedir / "config.ini").write_text(CONFIG_INI.format(NEW_VERSION if new else OLD_VERSION))
+
+	def write_pkg_version(self, gamedir: pathlib.Path):
+		"""
+		Writes the `pkg_version` file of the new version, as shipped with an install
+		"""
+		lines = []
+		for name, (_, size) in sorted(self.files.items()):
+			if size is not None:
+				entry = {"remoteName": name, "md5": _md5(self.file_data(name, True)), "fileSize": size}
+				lines.append(json.dumps(entry) + "\n")
+		(gamedir / "pkg_version").write_text("".join(lines))
+
+	def count_errors(self, gamedir: pathlib.Path) -> int:
+		"""
+		Returns the number of game files that do not match the new version
+		"""
+		errors = 0
+		for name, (_, new_size) in self.files.items():
+			path = gamedir / name
+			if new_size is None:
+				errors += path.exists()
+			elif not path.is_file() or path.read_bytes() != self.file_data(name, True):
+				errors += 1
+		return errors
+
+
+# ------------------- Fake API/CDN
+
+class FakeSophonHandler(StandInHandler):
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		self.do_GET()
+
+	def do_GET(self):
+		server: FakeSophonServer = self.server
+		path = self.path.split("?")[0]
+		if server.latency > 0:
+			time.sleep(server.latency)
+
+		if path.endswith("/getGameBranches"):
+			return self.send_json({"game_branches": [{
+				"main": {"package_id": "bench", "branch": "main", "password": "bench",
+					"tag": NEW_VERSION, "diff_tags": [OLD_VERSION]},
+				"pre_download": None
+			}]})
+		if path.endswith("/getBuild") or path.endswith("/getPatchBuild"):
+			diff = path.endswith("/getPatchBuild")
+			return self.send_json({"tag": NEW_VERSION, "manifests": [{
+				"matching_field": "game",
+				"manifest": {"id": "manifest_diff" if diff else "manifest_game"},
+				"manifest_download": {"url_prefix": server.base_url + "/manifests"},
+				"chunk_download": {"url_prefix": server.base_url + "/chunks"},
+				"diff_download": {"url_prefix": server.base_url + "/diffs"},
+			}]})
+
+		match = re.fullmatch(r"/(manifests|chunks|diffs)/(\w+)", path)
+		if not match:
+			return self.send_empty(404)
+		if match.group(1) != "manifests" and random.random() < server.error_rate:
+			return self.send_empty(503)
+		try:
+			body = (server.game.cdn / match.group(1) / match.group(2)).read_bytes()
+		except FileNotFoundError:
+			return self.send_empty(404)
+		server.count(self.send_body(body))
+
+	def send_json(self, data):
+		body = json.dumps({"retcode": 0, "message": "OK", "data": data}).encode()
+		self.send_body(body, content_type="application/json")
+
+
+class FakeSophonServer(StandInServer):
+	"""
+	Serves the API files, manifests, chunks and ldiff files of a `SyntheticGame`
+	latency:    seconds added to each request
+	error_rate: probability of "503 Service Unavailable" for chunk and ldiff requests
+	"""
+	def __init__(self, game: SyntheticGame, latency: float = 0.0, error_rate: float = 0.0):
+		self.game = game
+		self.latency = latency
+		self.error_rate = error_rate
+		self.bytes_served = 0
+		self._count_lock = threading.Lock()
+		super().__init__(FakeSophonHandler)
+
+	def count(self, nbytes: int):
+		with self._count_lock:
+			self.bytes_served += nbytes
+
+
+# ------------------- End-to-end benchmark
+
+class NullConnectionManager:
+	"""
+	Stands in for `utils.ConnectionManager`. Progress messages are counted, not sent.
+	"""
+	def __init__(self):
+		self.messages = 0
+
+	def send_message_threadsafe(self, message: dict, client_id: str):
+		self.messages += 1
+
+
+class PeakRSS:
+	"""
+	Samples the resident set size of this process while active
+	"""
+	INTERVAL = 0.02 # seconds
+
+	def __enter__(self):
+		self.peak = 0
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self._stop.set()
+		self._thread.join()
+
+	def _run(self):
+		proc = psutil.Process()
+		while not self._stop.is_set():
+			self.peak = max(self.peak, proc.memory_info().rss)
+			self._stop.wait(self.INTERVAL)
+
+
+def _bytes_written() -> int | None:
+	proc = psutil.Process()
+	if not hasattr(proc, "io_counters"): # not available on macOS
+		return None
+	return proc.io_counters().write_bytes
+
+def _damage(gamedir: pathlib.Path, game: SyntheticGame) -> int:
+	"""
+	Deletes, truncates or modifies every 5th file of the new version
+	Returns the number of damaged files
+	"""
+	damaged = 0
+	names = sorted(name for name, (_, size) in game.files.items() if size and name.endswith(".blk"))
+	for i, name in enumerate(names[::5]):
+		path = gamedir / name
+		if i % 3 == 0:
+			path.unlink()
+		elif i % 3 == 1:
+			with path.open("r+b") as fh:
+				fh.truncate(path.stat().st_size // 2)
+		else:
+			data = bytearray(path.read_bytes())
+			data[len(data) // 2] ^= 0xFF
+			path.write_bytes(data)
+		damaged += 1
+	return damaged
+
+def run_scenario(kind: str, game: SyntheticGame, server: FakeSophonServer, workdir: pathlib.Path) -> dict:
+	gamedir = workdir / kind
+	shutil.rmtree(gamedir, ignore_errors=True)
+	gamedir.mkdir(parents=True)
+	files = 0
+	if kind == "install":
+		request = InstallRequest(gamedir=str(gamedir), game_type="hk4e", install_reltype="os")
+		perform = tasks.perform_install
+		files = sum(1 for _, size in game.files.values() if size is not None)
+	elif kind == "update":
+		game.write_version(gamedir, new=False)
+		request = UpdateRequest(gamedir=str(gamedir), game_type="hk4e")
+		perform = tasks.perform_update
+		files = sum(1 for name, sizes in game.files.items() if None in sizes or name in game.modified)
+	elif kind in ("repair", "repair-offline"):
+		game.write_version(gamedir, new=True)
+		if kind == "repair-offline":
+			game.write_pkg_version(gamedir)
+		files = sum(1 for _, size in game.files.values() if size is not None)
+		_damage(gamedir, game)
+		request = RepairRequest(gamedir=str(gamedir), game_type="hk4e", repair_mode="reliable")
+		perform = tasks.perform_repair
+	else:
+		raise ValueError(kind)
+
+	task_id = kind
+	task_list = {task_id: TaskStatus(task_id=task_id, status="running")}
+	manager = NullConnectionManager()
+	server.bytes_served = 0
+	written = _bytes_written()
+	t_start = time.perf_counter()
+	with PeakRSS() as rss:
+		try:
+			perform(manager, task_list, task_id, request, threading.Event())
+		finally:
+			task_list[task_id].status = "completed"
+	elapsed = time.perf_counter() - t_start
+	if written is not None:
+		written = _bytes_written() - written
+
+	return {
+		"scenario": kind,
+		"wall_s": round(elapsed, 3),
+		"bytes_per_s": int(server.bytes_served / elapsed),
+		"files_per_s": round(files / elapsed, 1),
+		"peak_rss": rss.peak,
+		"bytes_written": written,
+		"errors": game.count_errors(gamedir),
+	}
+
+def bench_e2e(args):
+	workdir = pathlib.Path(tempfile.mkdtemp(prefix="sophon-bench-"))
+	try:
+		t_start = time.perf_counter()
+		game = SyntheticGame(workdir, args.files, args.min_size, args.max_size, args.chunk_size, args.seed)
+		print(f"Generated {args.files} files, {sophon_api.bytes_to_MiB(game.download_size)} MiB of chunks "
+			f"in {time.perf_counter() - t_start:.1f} s")
+
+		server = FakeSophonServer(game, args.latency, args.error_rate)
+		sophon_api.Options.api_host = server.base_url
+		results = []
+		try:
+			for kind in args.scenarios or ["install", "update", "repair", "repair-offline"]:
+				results.append(run_scenario(kind, game, server, workdir))
+		finally:
+			server.stop()
+
+		print(f"\n{'scenario':<15} {'wall s':>8} {'MiB/s':>8} {'files/s':>8} {'peak RSS MiB':>13} "
+			f"{'written MiB':>12} {'errors':>7}")
+		for r in results:
+			written = sophon_api.bytes_to_MiB(r["bytes_written"]) if r["bytes_written"] is not None else "n/a"
+			print(f"{r['scenario']:<15} {r['wall_s']:>8} {sophon_api.bytes_to_MiB(r['bytes_per_s']):>8} "
+				f"{r['files_per_s']:>8} {sophon_api.bytes_to_MiB(r['peak_rss']):>13} {written:>12} {r['errors']:>7}")
+		if args.json:
+			pathlib.Path(args.json).write_text(json.dumps(results, indent=1))
+	finally:
+		if args.keep:
+			print(f"Kept files in '{workdir}'")
+		else:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="sophon_server benchmarks")
+	sub = parser.add_subparsers(dest="command", required=True)
+
+	p_engine = sub.add_parser("engine", help="HTTP download engine requests/s")
+	p_engine.add_argument("--requests", type=int, default=2000)
+	p_engine.add_argument("--size", type=int, default=64 * 1024, help="response size in bytes")
+	p_engine.add_argument("--workers", type=int, default=sophon_api.WORKER_CNT)
+	p_engine.set_defaults(func=bench_engine)
+
+	p_e2e = sub.add_parser("e2e", help="install/update/repair against a fake API and CDN")
+	p_e2e.add_argument("scenarios", nargs="*", help="install, update, repair and/or repair-offline (default: all)")
+	p_e2e.add_argument("--files", type=int, default=200)
+	p_e2e.add_argument("--min-size", type=int, default=16 * 1024, help="bytes")
+	p_e2e.add_argument("--max-size", type=int, default=8 * 1024 * 1024, help="bytes")
+	p_e2e.add_argument("--chunk-size", type=int, default=1024 * 1024, help="bytes")
+	p_e2e.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+	p_e2e.add_argument("--error-rate", type=float, default=0.0, help="probability of HTTP 503 per request")
+	p_e2e.add_argument("--seed", type=int, default=1)
+	p_e2e.add_argument("--json", help="also write the results to this file")
+	p_e2e.add_argument("--keep", action="store_true", help="keep the generated files")
+	p_e2e.set_defaults(func=bench_e2e)
+
+	args = parser.parse_args()
+	args.func(args)
+
+
+if __name__ == "__main__":
+	main()
@@ -6,6 +6,8 @@ class GameOperationRequest(BaseModel):
     gamedir: str
     game_type: Literal["hk4e", "nap"]
     tempdir: Optional[str] = None
+    max_download_rate: Optional[int] = None  # bytes per second. None or 0: unlimited
+    priority: Literal["normal", "background"] = "normal"  # background: yield CPU and disk to other programs
 
 class InstallRequest(GameOperationRequest):
     install_reltype: str  # "os", "cn", or "bb"
@@ -14,7 +16,13 @@ class UpdateRequest(GameOperationRequest):
     predownload: bool = False
 
 class RepairRequest(GameOperationRequest):
-    repair_mode: str  # "quick" or "reliable"
+    repair_mode: str  # "quick", "balanced" or "reliable"
+    sample_percent: Optional[float] = None  # "balanced": share of each file to hash. None: default (5 %)
+
+
+class BandwidthLimit(BaseModel):
+    bytes_per_second: int = 0  # 0: unlimited
+    error: Optional[str] = None
 
 
 class TaskResponse(BaseModel):
@@ -13,6 +13,7 @@ class InstallProgressHandler:
         self.download_size = 0
         self.downloaded_size = 0
         self.download_speed = 0
+        self.download_concurrency = 0
         self._speed_thread = None
         self.last_broadcasted = time.time()
 
@@ -67,6 +68,23 @@ class InstallProgressHandler:
         self.download_size = download_size
         self._calculate_speed()
 
+    def dedup_summary(self, saved_bytes: int, duplicate_file_count: int):
+        self.conn_manager.send_message_threadsafe({
+            "type": "dedup_summary",
+            "task_id": self.task_id,
+            "saved_bytes": saved_bytes,
+            "duplicate_file_count": duplicate_file_count
+        }, self.task_id)
+
+    def download_concurrency_changed(self, concurrency: int, throughput: float):
+        self.download_concurrency = concurrency
+        self.conn_manager.send_message_threadsafe({
+            "type": "download_concurrency",
+            "task_id": self.task_id,
+            "concurrency": concurrency,
+            "throughput": throughput
+        }, self.task_id)
+
     def chunk_download_progress(self, filename:str, total_chunks: int, current_chunk: int, progress_percent: float, current_byte: int, total_bytes: int, chunk_size: int):
         self.downloaded_size += chunk_size
         if time.time() - self.last_broadcasted > BROADCAST_INTERVAL:
@@ -85,7 +103,8 @@ class InstallProgressHandler:
                     "downloaded_size": self.downloaded_size,
                     "total_size": self.download_size,
                     "overall_percent": (self.downloaded_size / self.download_size) * 100 if self.download_size > 0 else 0,
-                    "download_speed": self.download_speed
+                    "download_speed": self.download_speed,
+                    "download_concurrency": self.download_concurrency
                 }
             }, self.task_id)
             print(f"Current progress: {self.downloaded_size}/{self.download_size} bytes ({(self.downloaded_size / self.download_size) * 100 if self.download_size > 0 else 0:.2f}%)")
@@ -128,6 +147,7 @@ class RepairProgressHandler(InstallProgressHandler):
         self.repair_mode = None
         self.total_file_cnt = 0
         self.current_checked_file_cnt = 0
+        self.repair_file_cnt = 0  # damaged files, downloaded while the check goes on
 
     def repair_summary(self, repair_mode: str, total_files: int):
         self.repair_mode = repair_mode
@@ -141,6 +161,8 @@ class RepairProgressHandler(InstallProgressHandler):
 
     def check_file(self, filename: str, requires_repair: bool, reason: Optional[str] = None):
         self.current_checked_file_cnt += 1
+        if requires_repair:
+            self.repair_file_cnt += 1
         if self.current_checked_file_cnt % 10 == 0:
             self.conn_manager.send_message_threadsafe({
                 "type": "check_file",
@@ -151,10 +173,28 @@ class RepairProgressHandler(InstallProgressHandler):
                 "overall_progress": {
                     "total_files": self.total_file_cnt,
                     "checked_files": self.current_checked_file_cnt,
+                    "files_to_repair": self.repair_file_cnt,
                     "overall_percent": (self.current_checked_file_cnt / self.total_file_cnt) * 100 if self.total_file_cnt > 0 else 0
                 }
             }, self.task_id)
 
+    def repair_confidence(self, coverage: float, chunks_checked: int, chunks_damaged: int, damage_rate_upper_bound: float):
+        self.conn_manager.send_message_threadsafe({
+            "type": "repair_confidence",
+            "task_id": self.task_id,
+            "coverage": coverage,  # share of the checked bytes
+            "chunks_checked": chunks_checked,
+            "chunks_damaged": chunks_damaged,
+            "damage_rate_upper_bound": damage_rate_upper_bound  # 95 % confidence
+        }, self.task_id)
+
+    def unknown_files(self, filenames: List[str]):
+        self.conn_manager.send_message_threadsafe({
+            "type": "unknown_files",
+            "task_id": self.task_id,
+            "files": filenames
+        }, self.task_id)
+
 class UpdateProgressHandler(InstallProgressHandler):
     def __init__(self, task_id: str, conn_manager: ConnectionManager, tasks: Dict[str, TaskStatus]):
         super().__init__(task_id, conn_manager, tasks)
@@ -205,6 +245,16 @@ class UpdateProgressHandler(InstallProgressHandler):
         }, self.task_id)
         self._calculate_ldiff_speed()
 
+    def update_plan(self, ldiff_files: int, chunk_files: int, download_size: int, estimated_seconds: float):
+        self.conn_manager.send_message_threadsafe({
+            "type": "update_plan",
+            "task_id": self.task_id,
+            "ldiff_files": ldiff_files,  # modified files updated by patching
+            "chunk_files": chunk_files,  # modified files downloaded by chunks (cheaper)
+            "download_size": download_size,
+            "estimated_seconds": estimated_seconds
+        }, self.task_id)
+
     def ldiff_download_start(self, filename: str):
         self.conn_manager.send_message_threadsafe({
             "type": "ldiff_download_start",
@@ -9,6 +9,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from utils import *
 from models import *
 from tasks import *
+from sophon_api import RateLimiter, global_rate_limiter
 
 # Disable SSL verification
 ssl._create_default_https_context = ssl._create_unverified_context
@@ -27,6 +28,7 @@ main_event_loop: AbstractEventLoop = None
 manager: ConnectionManager = None
 tasks: Dict[str, TaskStatus] = {}
 task_cancel_events: Dict[str, threading.Event] = {}
+task_rate_limiters: Dict[str, RateLimiter] = {}
 
 
 def terminate_with_process(pid: int):
@@ -50,13 +52,17 @@ def run_task(task_type: Literal["install", "repair", "update"], request: Union[I
         status="pending",
     )
     task_cancel_events[task_id] = threading.Event()
+    task_rate_limiters[task_id] = RateLimiter(request.max_download_rate or 0)
+
+    def on_finished():
+        task_rate_limiters.pop(task_id, None)
 
     if task_type == "install":
-        run_task_in_thread(manager, tasks, task_id, perform_install, manager, tasks, task_id, request, task_cancel_events[task_id])
+        run_task_in_thread(manager, tasks, task_id, perform_install, manager, tasks, task_id, request, task_cancel_events[task_id], task_rate_limiters[task_id], on_finished=on_finished)
     elif task_type == "repair":
-        run_task_in_thread(manager, tasks, task_id, perform_repair, manager, tasks, task_id, request, task_cancel_events[task_id])
+        run_task_in_thread(manager, tasks, task_id, perform_repair, manager, tasks, task_id, request, task_cancel_events[task_id], task_rate_limiters[task_id], on_finished=on_finished)
     elif task_type == "update":
-        run_task_in_thread(manager, tasks, task_id, perform_update, manager, tasks, task_id, request, task_cancel_events[task_id])
+        run_task_in_thread(manager, tasks, task_id, perform_update, manager, tasks, task_id, request, task_cancel_events[task_id], task_rate_limiters[task_id], on_finished=on_finished)
     else:
         return TaskResponse(
             task_id=task_id,
@@ -90,6 +96,30 @@ async def cancel_task(task_id: str):
         task_cancel_events[task_id].set()
     return {"message": f"Task {task_id} cancelled"}
 
+@app.get("/api/tasks/{task_id}/bandwidth")
+async def get_task_bandwidth(task_id: str) -> BandwidthLimit:
+    limiter = task_rate_limiters.get(task_id)
+    if limiter is None:
+        return BandwidthLimit(error="Task not found")
+    return BandwidthLimit(bytes_per_second=limiter.rate)
+
+@app.put("/api/tasks/{task_id}/bandwidth")
+async def set_task_bandwidth(task_id: str, limit: BandwidthLimit) -> BandwidthLimit:
+    limiter = task_rate_limiters.get(task_id) # removed when the task finishes
+    if limiter is None:
+        return BandwidthLimit(error="Task not found")
+    limiter.set_rate(limit.bytes_per_second)
+    return BandwidthLimit(bytes_per_second=limiter.rate)
+
+@app.get("/api/bandwidth")
+async def get_bandwidth() -> BandwidthLimit:
+    return BandwidthLimit(bytes_per_second=global_rate_limiter.rate)
+
+@app.put("/api/bandwidth")
+async def set_bandwidth(limit: BandwidthLimit) -> BandwidthLimit:
+    global_rate_limiter.set_rate(limit.bytes_per_second)
+    return BandwidthLimit(bytes_per_second=global_rate_limiter.rate)
+
 @app.get("/api/game/online_info")
 async def get_online_game_info(reltype: str, game: Literal["nap", "hk4e"]) -> OnlineGameInfo:
     return fetch_online_game_info(reltype, game)
@@ -48,18 +48,25 @@
 from __future__ import annotations
 
 import argparse
+import collections # deque
 import gc
 import ctypes
+import ctypes.util # find_library
 import hashlib # md5
 import os
 import io # TextIOWrapper
 import json
+import mmap # file hashing
 import pathlib
+import random # sampled repair
 import re # Regular Expressions
 import shutil # rmtree
+import stat # S_ISREG
+import statistics # median
 import subprocess # for hpatchz (ldiff)
 import sys # stdout
 import tempfile # patch extraction
+import threading
 import time
 from typing import Literal, Optional
 import uuid
@@ -70,12 +77,19 @@ from typing import TYPE_CHECKING
 
 import psutil
 import zstandard # archive unpacking
+try:
+	import xxhash # chunk checksums (optional)
+except ImportError:
+	xxhash = None
+try:
+	import hdiffpatch # in-process ldiff patching (optional)
+except ImportError:
+	hdiffpatch = None
 from google.protobuf.json_format import MessageToJson
 
 import manifest_pb2 # generated
 import manifest_ldiff_pb2 # generated
 
-from io import BytesIO
 import pycurl
 import concurrent.futures
 
@@ -92,23 +106,80 @@ if not HPATCHZ_APP.is_file():
 	HPATCHZ_APP = SCRIPTDIR / "hpatchz"
 assert HPATCHZ_APP.is_file(), f"{HPATCHZ_APP.resolve()} not found."
 
-libc = ctypes.CDLL("libc.dylib")
-c_malloc_zone_pressure_relief = libc.malloc_zone_pressure_relief
-c_malloc_zone_pressure_relief.argtypes = [ctypes.c_void_p, ctypes.c_int]
-c_malloc_zone_pressure_relief.restype = ctypes.c_int
+libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.dylib", use_errno=True)
+c_malloc_zone_pressure_relief = getattr(libc, "malloc_zone_pressure_relief", None) # macOS only
+if c_malloc_zone_pressure_relief is not None:
+	c_malloc_zone_pressure_relief.argtypes = [ctypes.c_void_p, ctypes.c_int]
+	c_malloc_zone_pressure_relief.restype = ctypes.c_int
+
+# clonefile(2): copy-on-write file copies on APFS
+c_clonefile = getattr(libc, "clonefile", None)
+if c_clonefile is not None:
+	c_clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+	c_clonefile.restype = ctypes.c_int
 
 def force_memory_release():
 	gc.collect()
-	_ = c_malloc_zone_pressure_relief(None, 1)
+	if c_malloc_zone_pressure_relief is not None:
+		_ = c_malloc_zone_pressure_relief(None, 1)
 
 # Run only in compiled binary
 RUN_MEMORY_HACK = True
 
-# Worker count for multithreaded downloads
+# Initial number of chunk requests in flight. Adjusted at runtime within
+# `Options.min_download_concurrency` and `Options.max_download_concurrency`.
 WORKER_CNT = 8
+# Read buffer size for file hashing (per thread)
+HASH_BUFFER_SIZE = 1024 * 1024
+# Hash files through mmap windows of HASH_MMAP_WINDOW bytes instead of read calls
+HASH_USE_MMAP = False
+HASH_MMAP_WINDOW = 64 * 1024 * 1024
 # Worker count for verifying files
 # Do not use all cpu cores because it causes system slowdown
 WORKER_CNT_VERIFY = max(2, psutil.cpu_count(logical=False) - 4)
+# Files from this size on are verified as chunk ranges of about VERIFY_RANGE_SIZE bytes on multiple workers
+VERIFY_SPLIT_SIZE = 64 * 1024 * 1024
+VERIFY_RANGE_SIZE = 16 * 1024 * 1024
+# Threads listing the game directory in parallel
+SCAN_WORKER_CNT = 8
+# Updates download diff files and run hpatchz on separate workers.
+# At most LDIFF_PIPELINE_DEPTH diff files are on disk (download start to last patch).
+LDIFF_DOWNLOAD_WORKER_CNT = 4
+LDIFF_PATCH_WORKER_CNT = WORKER_CNT_VERIFY
+LDIFF_PIPELINE_DEPTH = LDIFF_DOWNLOAD_WORKER_CNT + LDIFF_PATCH_WORKER_CNT
+# Needed diff file sections at most LDIFF_RANGE_GAP bytes apart are fetched in one request.
+# Diff files are downloaded entirely if the requests would cover more than LDIFF_RANGE_MAX_SHARE.
+LDIFF_RANGE_GAP = 256 * 1024
+LDIFF_RANGE_MAX_SHARE = 0.8
+# Patch sections for hpatchz are extracted to this RAM-backed directory if it exists,
+# as long as a section takes at most half of its free space. Else to the system temp dir.
+# macOS has no tmpfs: sections are written to $TMPDIR on disk, and without copy_file_range
+# and sendfile to files they are copied through a buffer. hpatchz reads the streams of a
+# diff at random offsets, so a pipe cannot replace the file.
+PATCH_SECTION_DIR = "/dev/shm" if sys.platform == "linux" and os.path.isdir("/dev/shm") else None
+# Files are patched in-process (`hdiffpatch` module) instead of with hpatchz if the
+# old and the new file are at most this large. The files are held in memory.
+PATCH_IN_PROCESS_MAX_SIZE = 16 * 1024 * 1024 if hdiffpatch is not None else 0
+# Upper limit for the memory of all in-process patches (old file, patch and new file)
+PATCH_IN_PROCESS_MEMORY = 64 * 1024 * 1024
+# Update planner: assumed rates to compare patching a file against downloading its chunks
+PLAN_DOWNLOAD_RATE = 16 * 1024 * 1024 # bytes/s, unless limited to less
+PLAN_PATCH_RATE = 200 * 1024 * 1024   # bytes/s of the old plus the new file, per patch worker
+PLAN_CHUNK_RATE = 500 * 1024 * 1024   # bytes/s of decompressed and hashed chunk data
+PLAN_PATCH_PROCESS_TIME = 0.02        # seconds to start one hpatchz process
+# Connections kept open by the shared download engine
+DOWNLOAD_CONNECTIONS = 16
+# Threads driving the download engine. Chunks are decompressed on these.
+DOWNLOAD_LANES = min(4, psutil.cpu_count(logical=True))
+
+# Upper limit for the temporary files of downloads in progress (bytes). None: no limit
+TEMP_SPACE_BUDGET = None
+# Disk space to keep free when reserving temporary space (bytes)
+DISK_SPACE_MARGIN = 64 * 1024 * 1024
+
+# Verify the xxhash of each downloaded chunk (in addition to md5)
+# Disabled automatically if the manifest uses a different xxhash flavour
+CHUNK_XXHASH_CHECK = xxhash is not None
 
 # Not needed. Only helpful for development purposes.
 EXPORT_JSON_FILES = True
@@ -122,12 +193,22 @@ class Options(argparse.Namespace):
 	# where to place ldiff files and patched output files
 	#outputdir: pathlib.Path | None = SCRIPTDIR / "tmp" / "out"
 	force_use_cache: bool = False # True: disallow downloads, False: download if not cached
+	stream_chunks: bool = True    # True: decompress chunks while downloading, False: cache them in tempdir first
+	# Replaces the scheme and host of all API requests, e.g. "http://127.0.0.1:8080" (benchmarks)
+	api_host: str | None = os.environ.get("SOPHON_API_HOST")
+	min_download_concurrency: int = 2  # bounds for the adaptive number of chunk requests in flight
+	max_download_concurrency: int = 64
 	predownload: bool = False
 	install_reltype: str | None = None
 	game_type: Literal["hk4e", "nap"] | None # hk4e or nap
 	do_install: bool = False
 	do_update: bool = False         # True: ldiff, False: chunks
-	repair_mode: str | None = None  # "quick"|"reliable"|None
+	repair_mode: str | None = None  # "quick"|"balanced"|"reliable"|None
+	repair_sample_percent: float = 5.0 # "balanced" repair: share of each file to hash
+	repair_use_pkg_version: bool = True # True: verify offline against the pkg_version file of the install
+	repair_in_place: bool = True    # True: download only the damaged chunks of existing files
+	ldiff_ranges: bool = True       # True: download only the diff file sections needed by the installed files
+	background: bool = False        # True: low CPU/IO priority, fewer workers while the system is busy
 	dry_run: bool = False           # True: prevents modifying game files
 	disallow_download: bool = False # True: prevents media downloads
 
@@ -199,6 +280,13 @@ def try_get_file_size(filename: pathlib.Path):
 	except FileNotFoundError:
 		return -1
 
+def download_temp_path(filename: str) -> pathlib.Path:
+	"""
+	Temporary location of a game file while its chunks are being downloaded
+	filename: path relative to the game directory
+	"""
+	return tempdir(filename.replace("/", "__"))
+
 def filename_safety_check(filename):
 	"""
 	Checks whether the path is relative AND within this tree
@@ -210,6 +298,423 @@ def filename_safety_check(filename):
 def bytes_to_MiB(n: float):
 	return int(n / (1024 * 1024 / 10) + 0.5) / 10
 
+class PositionalWriter:
+	"""
+	Minimal file-like sink that writes to `fd` starting at `offset`.
+	Uses `os.pwrite`, thus the shared file position of `fd` is not touched.
+	All written data is also fed to the given `hashers` (optional).
+	"""
+	def __init__(self, fd: int, offset: int, *hashers):
+		self.fd = fd
+		self.offset = offset
+		self.bytes_written = 0
+		self.hashers = [h for h in hashers if h is not None]
+
+	def write(self, data) -> int:
+		for h in self.hashers:
+			h.update(data)
+		view = memoryview(data)
+		while len(view) > 0:
+			n = os.pwrite(self.fd, view, self.offset)
+			self.offset += n
+			self.bytes_written += n
+			view = view[n:]
+		return len(data)
+
+class ChecksumError(ValueError):
+	pass
+
+def verify_chunk_hashes(chunk: manifest_pb2.ChunkInfo, xxh = None, md5 = None):
+	"""
+	Compares the checksums of a downloaded chunk against the manifest
+	xxh: `xxhash.xxh64` of the compressed data or `None`
+	md5: `hashlib.md5` of the uncompressed data or `None`
+	Raises `ChecksumError` on mismatch.
+	"""
+	global CHUNK_XXHASH_CHECK
+	md5_ok = (md5 is None) or md5.hexdigest() == chunk.md5
+	if xxh is not None and xxh.intdigest() != chunk.xxhash:
+		if md5 is not None and md5_ok:
+			# The data is fine, thus the manifest uses another xxhash flavour
+			warnlog("Chunk xxhash does not match the expected format. Disabling xxhash checks.")
+			CHUNK_XXHASH_CHECK = False
+			return
+		raise ChecksumError(f"xxhash mismatch in chunk {chunk.chunk_id}")
+	if not md5_ok:
+		raise ChecksumError(f"md5 mismatch in chunk {chunk.chunk_id}")
+
+def chunk_hashers(chunk: manifest_pb2.ChunkInfo) -> tuple:
+	"""
+	Returns new (xxhash of the compressed data, md5 of the uncompressed data) objects
+	for the checksums that are available. Either may be `None`.
+	"""
+	xxh = xxhash.xxh64() if (CHUNK_XXHASH_CHECK and chunk.xxhash) else None
+	md5 = hashlib.md5() if chunk.md5 else None
+	return xxh, md5
+
+# ------------------- Hashing
+
+_hash_local = threading.local()
+
+def _hash_buffer() -> memoryview:
+	"""
+	Returns the read buffer of the calling thread. Reused for all files.
+	"""
+	view = getattr(_hash_local, "view", None)
+	if view is None:
+		view = _hash_local.view = memoryview(bytearray(HASH_BUFFER_SIZE))
+	return view
+
+def _pread_into(fd: int, view: memoryview, offset: int) -> int:
+	if hasattr(os, "preadv"):
+		return os.preadv(fd, [view], offset)
+	data = os.pread(fd, len(view), offset)
+	view[:len(data)] = data
+	return len(data)
+
+def _hash_fd_mmap(fd: int, hasher, offset: int, end: int) -> int:
+	position = offset
+	while position < end:
+		base = position - position % mmap.ALLOCATIONGRANULARITY
+		size = min(HASH_MMAP_WINDOW, end - base)
+		with mmap.mmap(fd, size, access=mmap.ACCESS_READ, offset=base) as window:
+			with memoryview(window)[position - base:] as view:
+				hasher.update(view)
+		position = base + size
+	return end - offset
+
+def hash_fd(fd: int, hasher, offset: int = 0, length: int | None = None, use_mmap: bool | None = None) -> int:
+	"""
+	Feeds the file contents from `offset` on into `hasher` (e.g. `hashlib.md5()`)
+	Memory use per thread is bounded by `HASH_BUFFER_SIZE`, or by `HASH_MMAP_WINDOW`
+	in mmap mode. The file position of `fd` is not used.
+	length:   number of bytes, or `None` to read until the end of the file
+	use_mmap: `None` for the default, `HASH_USE_MMAP`
+	Returns the number of bytes hashed, which is less than `length` for short files.
+	"""
+	end = os.fstat(fd).st_size
+	if length is not None:
+		end = min(end, offset + length)
+	if use_mmap if use_mmap is not None else HASH_USE_MMAP:
+		return _hash_fd_mmap(fd, hasher, offset, end)
+
+	view = _hash_buffer()
+	position = offset
+	while position < end:
+		n = _pread_into(fd, view[:min(len(view), end - position)], position)
+		if n == 0:
+			break # truncated meanwhile
+		hasher.update(view[:n])
+		position += n
+	return position - offset
+
+def chunk_intact(fd: int, chunk: manifest_pb2.ChunkInfo) -> bool:
+	"""
+	Returns `True` if the file contains the uncompressed data of `chunk` at `chunk.offset`
+	"""
+	if not chunk.md5:
+		return False
+	md5 = hashlib.md5()
+	n = hash_fd(fd, md5, chunk.offset, chunk.uncompressed_size)
+	return n == chunk.uncompressed_size and md5.hexdigest() == chunk.md5
+
+def split_chunk_ranges(file_info: manifest_pb2.FileInfo, range_size: int) -> list[list[manifest_pb2.ChunkInfo]] | None:
+	"""
+	Groups the chunks of a file into consecutive ranges of about `range_size` bytes.
+	Returns `None` if the chunks do not cover the entire file or lack an md5.
+	"""
+	ranges = []
+	current = []
+	current_size = 0
+	position = 0
+	for c in sorted(file_info.chunks, key=lambda c: c.offset):
+		if c.offset != position or not c.md5:
+			return None
+		position += c.uncompressed_size
+		current.append(c)
+		current_size += c.uncompressed_size
+		if current_size >= range_size:
+			ranges.append(current)
+			current = []
+			current_size = 0
+	if position != file_info.size:
+		return None
+	if current:
+		ranges.append(current)
+	return ranges
+
+def sample_chunks(file_info: manifest_pb2.FileInfo, percent: float, rng: random.Random) -> list[manifest_pb2.ChunkInfo]:
+	"""
+	Picks random chunks that make up about `percent` % of the file.
+	The first and the last chunk are always included. Chunks without md5 are skipped.
+	Returns the chunks sorted by offset.
+	"""
+	chunks = sorted((c for c in file_info.chunks if c.md5), key=lambda c: c.offset)
+	if len(chunks) <= 2:
+		return chunks
+	picked = [chunks[0], chunks[-1]]
+	size = chunks[0].uncompressed_size + chunks[-1].uncompressed_size
+	middle = chunks[1:-1]
+	rng.shuffle(middle)
+	for c in middle:
+		if size >= file_info.size * percent / 100:
+			break
+		picked.append(c)
+		size += c.uncompressed_size
+	picked.sort(key=lambda c: c.offset)
+	return picked
+
+def damage_rate_upper_bound(damaged: int, checked: int, z: float = 1.96) -> float:
+	"""
+	Upper end of the Wilson score interval (95 % by default) for the share of
+	damaged chunks, estimated from `checked` randomly picked chunks.
+	"""
+	if checked == 0:
+		return 1.0
+	p = damaged / checked
+	z2 = z * z / checked
+	return min(1.0, (p + z2 / 2 + z * ((p * (1 - p) + z2 / 4) / checked) ** 0.5) / (1 + z2))
+
+def md5_file(filename: pathlib.Path) -> str:
+	"""
+	Returns the MD5 hex digest of a file. See `hash_fd` for the memory use.
+	"""
+	md5 = hashlib.md5()
+	fd = os.open(filename, os.O_RDONLY)
+	try:
+		hash_fd(fd, md5)
+	finally:
+		os.close(fd)
+	return md5.hexdigest()
+
+class IncrementalMD5:
+	"""
+	Whole-file MD5 of a file that is assembled from chunks, possibly out of order.
+
+	Data written at the current hash position is hashed while it is written
+	(see `begin`). Chunks that complete ahead of that position are read back
+	from `fd` with a bounded buffer as soon as the gap before them is closed.
+	"""
+	def __init__(self, fd: int):
+		self.fd = fd
+		self.position = 0 # all data before this offset is hashed
+		self._md5 = hashlib.md5()
+		self._ahead: dict[int, int] = {} # offset -> length of completed chunks
+		self._lock = threading.Lock()
+
+	def begin(self, offset: int):
+		"""
+		Returns a hash object to be fed with the data written at `offset`,
+		or `None` if the data has to be read back later.
+		Call once per write attempt. Failed attempts are discarded.
+		"""
+		with self._lock:
+			if offset == self.position:
+				return self._md5.copy()
+			return None
+
+	def complete(self, offset: int, length: int, hasher = None):
+		"""
+		Marks the range as written. `hasher` is the object returned by `begin`.
+		"""
+		with self._lock:
+			if hasher is not None and offset == self.position:
+				self._md5 = hasher
+				self.position += length
+			else:
+				self._ahead[offset] = length
+
+			while self.position in self._ahead:
+				length = self._ahead.pop(self.position)
+				n = hash_fd(self.fd, self._md5, self.position, length, use_mmap=False)
+				self.position += n
+				if n < length:
+					return # truncated file. `hexdigest` will not match the size.
+
+	def hexdigest(self, size: int) -> str | None:
+		"""
+		Returns `None` if not all bytes up to `size` were hashed
+		"""
+		with self._lock:
+			if self.position != size or self._ahead:
+				return None
+			return self._md5.hexdigest()
+
+# ------------------- Verification index
+
+class VerifyIndex:
+	"""
+	Remembers the MD5 of verified game files, keyed by their file metadata.
+	A file whose size, mtime and inode did not change since it was verified
+	does not need to be hashed again. Stored as JSON lines, last entry wins.
+	"""
+	FLUSH_INTERVAL = 256 # records
+
+	def __init__(self, path: pathlib.Path):
+		self.path = path
+		self._entries: dict[str, dict] = {}
+		self._pending: list[dict] = []
+		self._lines = 0
+		self._lock = threading.Lock()
+		self._load()
+
+	def _load(self):
+		try:
+			fh = self.path.open("r", encoding="utf-8")
+		except FileNotFoundError:
+			return
+		with fh:
+			for line in fh:
+				self._lines += 1
+				try:
+					entry = json.loads(line)
+					self._entries[entry["filename"]] = entry
+				except (ValueError, KeyError, TypeError):
+					pass # partially written line
+
+	@staticmethod
+	def _key(st: os.stat_result) -> list:
+		return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+	def lookup(self, filename: str, st: os.stat_result | None = None) -> str | None:
+		"""
+		Returns the recorded MD5 of `filename` if the file was not changed since.
+		st: result of `os.stat(gamedir(filename))`, if already known
+		"""
+		with self._lock:
+			entry = self._entries.get(filename)
+		if entry is None:
+			return None
+		if st is None:
+			try:
+				st = os.stat(gamedir(filename))
+			except OSError:
+				return None
+		if entry["stat"] != self._key(st):
+			return None
+		return entry["md5"]
+
+	def record(self, filename: str, md5: str, tag: str | None = None):
+		"""
+		Records the MD5 of the game file `filename`, which was just verified or written.
+		"""
+		if OPT.dry_run:
+			return
+		try:
+			st = os.stat(gamedir(filename))
+		except OSError:
+			return
+		entry = { "filename": filename, "stat": self._key(st), "md5": md5, "tag": tag }
+		with self._lock:
+			self._entries[filename] = entry
+			self._pending.append(entry)
+			flush = len(self._pending) >= self.FLUSH_INTERVAL
+		if flush:
+			self.flush()
+
+	def flush(self):
+		"""
+		Writes the new records to disk. Rewrites the file once most lines are outdated.
+		"""
+		with self._lock:
+			if not self._pending:
+				return
+			try:
+				if self._lines + len(self._pending) > 2 * len(self._entries) + self.FLUSH_INTERVAL:
+					tmpname = self.path.with_suffix(".tmp")
+					with tmpname.open("w", encoding="utf-8") as fh:
+						for entry in self._entries.values():
+							fh.write(json.dumps(entry) + "\n")
+					os.replace(tmpname, self.path)
+					self._lines = len(self._entries)
+				else:
+					with self.path.open("a", encoding="utf-8") as fh:
+						for entry in self._pending:
+							fh.write(json.dumps(entry) + "\n")
+					self._lines += len(self._pending)
+			except OSError as e:
+				warnlog(f"Cannot write the verification index: {e}")
+			self._pending.clear()
+
+# ------------------- Directory snapshot
+
+class DirectorySnapshot:
+	"""
+	Metadata of all entries below `root`, collected in one parallel walk with `os.scandir`.
+	Keys are relative paths with "/" separators, as in the manifests.
+	exclude: relative paths of directories to skip (e.g. temporary files)
+	"""
+	def __init__(self, root: pathlib.Path, exclude = (), workers: int = SCAN_WORKER_CNT):
+		self.root = root
+		self.entries: dict[str, os.stat_result] = {}
+		self._exclude = set(exclude)
+		self._scan(workers)
+
+	def _scan_dir(self, relpath: str) -> tuple[dict[str, os.stat_result], list[str]]:
+		entries = {}
+		subdirs = []
+		prefix = relpath + "/" if relpath else ""
+		try:
+			with os.scandir(self.root / relpath) as it:
+				for entry in it:
+					name = prefix + entry.name
+					if name in self._exclude:
+						continue
+					try:
+						entries[name] = entry.stat()
+						if entry.is_dir(follow_symlinks=False):
+							subdirs.append(name)
+					except OSError:
+						pass # removed meanwhile
+		except OSError as e:
+			warnlog(f"Cannot list directory '{relpath}': {e}")
+		return entries, subdirs
+
+	def _scan(self, workers: int):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			pending = { executor.submit(self._scan_dir, "") }
+			while pending:
+				done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					entries, subdirs = future.result()
+					self.entries.update(entries)
+					pending.update(executor.submit(self._scan_dir, d) for d in subdirs)
+
+	def stat(self, filename: str) -> os.stat_result | None:
+		return self.entries.get(filename)
+
+	def size(self, filename: str) -> int:
+		"""
+		Returns -1 if the file was not found (same as `try_get_file_size`)
+		"""
+		st = self.entries.get(filename)
+		return -1 if st is None else st.st_size
+
+	def is_file(self, filename: str) -> bool:
+		st = self.entries.get(filename)
+		return st is not None and stat.S_ISREG(st.st_mode)
+
+	def unknown_files(self, known) -> list[str]:
+		"""
+		Returns the files that are not contained in `known` (set of file names)
+		"""
+		return sorted(name for name, st in self.entries.items()
+			if stat.S_ISREG(st.st_mode) and name not in known)
+
+
+class PkgVersionEntry:
+	"""
+	One line of a `pkg_version` file. Provides the `FileInfo` fields that are needed for verification.
+	"""
+	flags = 0
+	chunks = ()
+
+	def __init__(self, filename: str, size: int, md5: str):
+		self.filename = filename
+		self.size = size
+		self.md5 = md5
+
+
 def cmp_versions(lhs: list, rhs: list) -> int:
 	"""
 	Returns [1 if lhs > rhs], [-1 if lhs < rhs], [0 if equal]
@@ -222,6 +727,165 @@ def cmp_versions(lhs: list, rhs: list) -> int:
 			return 1
 	return 0
 
+# ------------------- Partial ldiff files
+
+def coalesce_ranges(ranges, max_gap: int = 0) -> list[tuple[int, int]]:
+	"""
+	Merges (offset, length) ranges that overlap or are at most `max_gap` bytes apart
+	Returns the merged ranges, sorted by offset
+	"""
+	merged = []
+	for offset, length in sorted(ranges):
+		if merged and offset <= merged[-1][0] + merged[-1][1] + max_gap:
+			start, size = merged[-1]
+			merged[-1] = (start, max(size, offset + length - start))
+		else:
+			merged.append((offset, length))
+	return merged
+
+class LdiffSections:
+	"""
+	Sidecar file of a partially downloaded ldiff file. The ldiff file is sparse and
+	has its full size, but only the listed (offset, length) sections contain data.
+	An ldiff file without sidecar is complete.
+	"""
+	def __init__(self, ldiffname: pathlib.Path):
+		self.path = ldiffname.with_name(ldiffname.name + ".ranges")
+		self.ranges: list[tuple[int, int]] = []
+		if self.path.is_file():
+			self.ranges = [tuple(r) for r in json.loads(self.path.read_text())]
+
+	def exists(self) -> bool:
+		return self.path.is_file()
+
+	def covers(self, offset: int, length: int) -> bool:
+		return any(start <= offset and offset + length <= start + size for start, size in self.ranges)
+
+	def add(self, offset: int, length: int):
+		"""
+		Records a downloaded section. Call with `length=0` to create the sidecar.
+		"""
+		if length > 0:
+			self.ranges = coalesce_ranges(self.ranges + [(offset, length)])
+		tmp = self.path.with_name(self.path.name + ".tmp")
+		tmp.write_text(json.dumps(self.ranges))
+		os.replace(tmp, self.path)
+
+	def remove(self):
+		self.path.unlink(missing_ok=True)
+		self.ranges = []
+
+
+def copy_file_section(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+	"""
+	Copies `length` bytes of `src_fd` from `offset` on to the current position of `dst_fd`.
+	The data is copied in the kernel where supported, else through the thread's buffer.
+
+	Returns the number of bytes copied (less on EOF)
+	"""
+	copied = 0
+	if hasattr(os, "copy_file_range"):
+		try:
+			while copied < length:
+				n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied)
+				if n == 0:
+					return copied
+				copied += n
+		except OSError:
+			pass # e.g. not supported by the file system
+	if copied < length and sys.platform == "linux": # sendfile to regular files
+		try:
+			while copied < length:
+				n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+				if n == 0:
+					return copied
+				copied += n
+		except OSError:
+			pass
+	view = _hash_buffer()
+	while copied < length:
+		n = _pread_into(src_fd, view[:min(len(view), length - copied)], offset + copied)
+		if n == 0:
+			break
+		data = view[:n]
+		while len(data) > 0:
+			data = data[os.write(dst_fd, data):]
+		copied += n
+	return copied
+
+class MemoryBudget:
+	"""
+	Bounds the bytes held in memory by concurrent jobs. A job larger than the
+	entire budget runs alone.
+	"""
+	def __init__(self, limit: int):
+		self.limit = limit
+		self.used = 0
+		self._cond = threading.Condition()
+
+	def acquire(self, nbytes: int):
+		with self._cond:
+			while self.used > 0 and self.used + nbytes > self.limit:
+				self._cond.wait()
+			self.used += nbytes
+
+	def release(self, nbytes: int):
+		with self._cond:
+			self.used -= nbytes
+			self._cond.notify_all()
+
+patch_memory = MemoryBudget(PATCH_IN_PROCESS_MEMORY)
+
+def read_file_section(filename: pathlib.Path, offset: int, length: int) -> bytes:
+	"""
+	Returns `length` bytes of the file from `offset` on (less on EOF)
+	"""
+	parts = []
+	with filename.open("rb") as fh:
+		while length > 0:
+			data = os.pread(fh.fileno(), length, offset)
+			if not data:
+				break
+			parts.append(data)
+			offset += len(data)
+			length -= len(data)
+	return b"".join(parts)
+
+def hdiffpatch_patch_file(oldfile: pathlib.Path, dstfile: pathlib.Path, patchfile: pathlib.Path,
+		p_offset: int, p_len: int, new_size: int) -> str | None:
+	"""
+	Patches a file in-process. Same as `hpatchz_patch_file` without a process per file.
+	hdiffpatch releases the GIL while patching, thus multiple files can be patched in parallel.
+	The memory of concurrent patches is bounded by `patch_memory`.
+	new_size: size of the patched file
+
+	Returns the md5 hash of the patched file, or `None` if hpatchz must be used instead
+	"""
+	nbytes = try_get_file_size(oldfile) + p_len + new_size
+	patch_memory.acquire(nbytes)
+	try:
+		diff = read_file_section(patchfile, p_offset, p_len)
+		if len(diff) != p_len:
+			abortlog(f"Diff file '{patchfile.name}' is truncated. Please redownload.")
+		try:
+			data = hdiffpatch.apply(oldfile.read_bytes(), diff)
+		except (hdiffpatch.HDiffPatchError, MemoryError) as e:
+			warnlog(f"In-process patching failed on file '{oldfile.name}' ({e}). Using hpatchz.")
+			return None
+		del diff
+
+		# Hash the output while it is written
+		md5 = hashlib.md5()
+		view = memoryview(data)
+		with dstfile.open("wb") as fh:
+			writer = PositionalWriter(fh.fileno(), 0, md5)
+			for offset in range(0, len(view), HASH_BUFFER_SIZE):
+				writer.write(view[offset:offset + HASH_BUFFER_SIZE])
+		view.release()
+		return md5.hexdigest()
+	finally:
+		patch_memory.release(nbytes)
+
 def hpatchz_patch_file(oldfile: pathlib.Path, dstfile: pathlib.Path, patchfile: pathlib.Path,
 		p_offset: int, p_len: int, timeout: int = 50):
 	"""
@@ -231,20 +895,26 @@ def hpatchz_patch_file(oldfile: pathlib.Path, dstfile: pathlib.Path, patchfile:
 	Returns `True` on success, `False` on timeout
 	"""
 
-	pfile_in = None   # keep alive until functoin exit
+	pfile_out = None   # keep alive until function exit
 
-	# Extract the relevant patch section
-	# Note: This is also needed if `p_offset == 0`. Unlike other archiver programs or
-	# libraries, hpatchz does not allow tailing data.
-	pfile_in = patchfile.open("rb")
-	pfile_in.seek(p_offset)
-	pfile_out = tempfile.NamedTemporaryFile("wb")
-	pfile_out.write(pfile_in.read(p_len))
-	pfile_out.flush()
+	# Unlike other archiver programs or libraries, hpatchz does not allow tailing data.
+	# Thus the relevant patch section is extracted unless it is the entire file.
+	if p_offset == 0 and p_len == try_get_file_size(patchfile):
+		patch_path = patchfile
+	else:
+		section_dir = PATCH_SECTION_DIR
+		if section_dir and p_len > shutil.disk_usage(section_dir).free // 2:
+			section_dir = None
+		pfile_out = tempfile.NamedTemporaryFile("wb", dir=section_dir)
+		with patchfile.open("rb") as pfile_in:
+			copied = copy_file_section(pfile_in.fileno(), pfile_out.fileno(), p_offset, p_len)
+		if copied != p_len:
+			abortlog(f"Diff file '{patchfile.name}' is truncated. Please redownload.")
+		patch_path = pfile_out.name
 
 	proc = subprocess.Popen(
 		# -f: overwrite the target (temporary) file
-		[HPATCHZ_APP, "-f", oldfile, pfile_out.name, dstfile],
+		[HPATCHZ_APP, "-f", oldfile, patch_path, dstfile],
 		stdout=subprocess.PIPE, stderr=subprocess.PIPE,
 		text=True
 	)
@@ -294,14 +964,1168 @@ def get_game_version(game_data_dir: pathlib.Path, offset: int = 0x88) -> Optiona
 			index = i
 			break
 
-	if index == -1:
-		raise ValueError("pattern not found")
-	else:
-		len_index = index + offset
-		strlen = struct.unpack_from('<I', view, len_index)[0]
-		str_bytes = view[len_index + 4: len_index + 4 + strlen]
-		str_val = str_bytes.decode('ascii')
-		return str_val.split('_')[0]
+	if index == -1:
+		raise ValueError("pattern not found")
+	else:
+		len_index = index + offset
+		strlen = struct.unpack_from('<I', view, len_index)[0]
+		str_bytes = view[len_index + 4: len_index + 4 + strlen]
+		str_val = str_bytes.decode('ascii')
+		return str_val.split('_')[0]
+
+
+# ------------------- Download engine
+
+class RateLimiter:
+	"""
+	Token bucket for the download bandwidth. Can be shared by any number of transfers.
+	A transfer may overdraw the bucket by one received block. It is then paused
+	by the download engine until the debt is paid off.
+	rate: bytes per second, 0 = unlimited. Can be changed while downloading.
+	"""
+	BURST_SECONDS = 0.25
+	changes = 0 # incremented by every `set_rate` of any limiter
+
+	def __init__(self, rate: int = 0):
+		self._lock = threading.Lock()
+		self._tokens = 0.0
+		self._updated = time.monotonic()
+		self.rate = 0
+		self.set_rate(rate)
+
+	def set_rate(self, rate: int):
+		with self._lock:
+			self._refill()
+			self.rate = max(0, int(rate))
+			self._tokens = min(self._tokens, self._burst())
+			RateLimiter.changes += 1
+
+	def _burst(self) -> float:
+		return max(64 * 1024, self.rate * self.BURST_SECONDS)
+
+	def _refill(self):
+		now = time.monotonic()
+		if self.rate > 0:
+			self._tokens = min(self._burst(), self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def delay(self) -> float:
+		"""
+		Returns the seconds until data may be received again
+		"""
+		with self._lock:
+			if self.rate <= 0:
+				return 0.0
+			self._refill()
+			return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+	def consume(self, nbytes: int):
+		with self._lock:
+			if self.rate > 0:
+				self._refill()
+				self._tokens -= nbytes
+
+# Limit for all downloads of this process
+global_rate_limiter = RateLimiter()
+
+
+class DownloadRequest:
+	"""
+	One transfer handled by `DownloadEngine`
+	`on_data(bytes)` is called by the engine thread for each received block.
+	Return values follow the pycurl WRITEFUNCTION convention.
+	"""
+	def __init__(self, url: str, on_data, byte_range: str | None = None, monitor = None,
+			limiters: list[RateLimiter] | None = None):
+		self.url = url
+		self.on_data = on_data
+		self.byte_range = byte_range # "first-last" or "first-"
+		self.monitor = monitor # (optional) `monitor.request_done(self)` is called when finished
+		self.limiters = limiters or [] # bandwidth limits that apply to this transfer
+		self.response_code = 0
+		self.error: tuple[int, str] | None = None # (errno, message) as in `pycurl.error`
+		self.ttfb = 0.0 # seconds from sending the request (on a connection) to the first byte
+		self.bytes_received = 0
+		self._done = threading.Event()
+
+	def wait(self) -> DownloadRequest:
+		self._done.wait()
+		return self
+
+	def raise_for_error(self):
+		if self.error:
+			raise pycurl.error(*self.error)
+
+
+class _DownloadLane:
+	"""
+	One thread driving one `pycurl.CurlMulti` handle.
+	Finished easy handles are kept for the next transfer, thus the connections
+	stay alive and are reused.
+	"""
+	SELECT_TIMEOUT = 0.02 # seconds. Upper bound of the latency to pick up new requests
+	LOW_SPEED_TIME = 60 # seconds below the low speed limit until a transfer is aborted
+
+	def __init__(self, engine: DownloadEngine, index: int):
+		self.engine = engine
+		self._multi = pycurl.CurlMulti()
+		self._multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+		self._multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, engine.connections_per_lane)
+		self._multi.setopt(pycurl.M_MAXCONNECTS, engine.connections_per_lane)
+		self._idle: list[pycurl.Curl] = []
+		self._active: dict[pycurl.Curl, DownloadRequest] = {}
+		self._paused: dict[pycurl.Curl, DownloadRequest] = {} # waiting for bandwidth
+		self._pending: list[DownloadRequest] = []
+		self._starting: list[DownloadRequest] = [] # taken from `_pending`, not yet added to `_multi`
+		self._cond = threading.Condition()
+		self.dead = False # the lane thread crashed. Requests fail immediately.
+		self._limiter_changes = RateLimiter.changes # last applied by `_update_low_speed_limits`
+		self._thread = threading.Thread(target=self._run, name=f"download-lane-{index}", daemon=True)
+		self._thread.start()
+
+	def load(self) -> int:
+		return len(self._active) + len(self._pending)
+
+	def submit(self, req: DownloadRequest):
+		with self._cond:
+			if not self.dead:
+				self._pending.append(req)
+				self._cond.notify()
+				return
+		self._fail(req, "download lane is not running")
+
+	def _make_handle(self, req: DownloadRequest) -> pycurl.Curl:
+		if self._idle:
+			c = self._idle.pop()
+		else:
+			c = self._new_handle()
+		c.setopt(pycurl.URL, req.url)
+		if req.limiters:
+			c.setopt(pycurl.WRITEFUNCTION, lambda data: self._limited_write(c, req, data))
+		else:
+			c.setopt(pycurl.WRITEFUNCTION, req.on_data)
+		c.setopt(pycurl.LOW_SPEED_LIMIT, self._low_speed_limit(req))
+		if req.byte_range:
+			c.setopt(pycurl.RANGE, req.byte_range)
+		else:
+			c.unsetopt(pycurl.RANGE)
+		return c
+
+	@staticmethod
+	def _low_speed_limit(req: DownloadRequest) -> int:
+		"""
+		Returns the bytes/s below which a transfer counts as stalled. Limited
+		transfers may be slower than any fixed threshold.
+		"""
+		return 1 if any(limiter.rate > 0 for limiter in req.limiters) else 1024
+
+	def _update_low_speed_limits(self):
+		"""
+		Applies changed bandwidth limits to the transfers in progress
+		"""
+		changes = RateLimiter.changes
+		if changes == self._limiter_changes:
+			return
+		self._limiter_changes = changes
+		for c, req in self._active.items():
+			c.setopt(pycurl.LOW_SPEED_LIMIT, self._low_speed_limit(req))
+
+	def _new_handle(self) -> pycurl.Curl:
+		c = pycurl.Curl()
+		c.setopt(pycurl.SHARE, self.engine.share)
+		c.setopt(pycurl.NOSIGNAL, 1)
+		c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+		c.setopt(pycurl.PIPEWAIT, 1) # prefer multiplexing over new connections
+		c.setopt(pycurl.TCP_KEEPALIVE, 1)
+		c.setopt(pycurl.CONNECTTIMEOUT, 30)
+		# Abort stalled transfers so that the caller can retry (see also `_low_speed_limit`)
+		c.setopt(pycurl.LOW_SPEED_TIME, self.LOW_SPEED_TIME)
+		c.setopt(pycurl.FAILONERROR, True)
+		return c
+
+	def _limited_write(self, c: pycurl.Curl, req: DownloadRequest, data: bytes):
+		if any(limiter.delay() > 0 for limiter in req.limiters):
+			# curl delivers the same data again after `_resume_paused`
+			self._paused[c] = req
+			return pycurl.WRITEFUNC_PAUSE
+		for limiter in req.limiters:
+			limiter.consume(len(data))
+		return req.on_data(data)
+
+	def _resume_paused(self):
+		for c, req in list(self._paused.items()):
+			if all(limiter.delay() <= 0 for limiter in req.limiters):
+				del self._paused[c]
+				c.pause(pycurl.PAUSE_CONT)
+
+	def _finish(self, c: pycurl.Curl, error: tuple[int, str] | None):
+		req = self._active.pop(c)
+		self._paused.pop(c, None)
+		self._multi.remove_handle(c)
+		req.response_code = c.getinfo(pycurl.RESPONSE_CODE)
+		# Without the time waiting for a free connection: requests above the connection
+		# limit are queued inside curl, which is not a sign of network congestion.
+		req.ttfb = max(0.0, c.getinfo(pycurl.STARTTRANSFER_TIME) - c.getinfo(pycurl.PRETRANSFER_TIME))
+		req.bytes_received = int(c.getinfo(pycurl.SIZE_DOWNLOAD))
+		req.error = error
+		if len(self._idle) < self.engine.connections_per_lane:
+			self._idle.append(c)
+		else:
+			c.close()
+		if req.monitor:
+			try:
+				req.monitor.request_done(req)
+			except Exception as e:
+				warnlog(f"Download monitor failed: {e}")
+		req._done.set()
+
+	@staticmethod
+	def _fail(req: DownloadRequest, message: str):
+		req.error = (pycurl.E_ABORTED_BY_CALLBACK, message)
+		req._done.set()
+
+	def _run(self):
+		try:
+			self._loop()
+		except BaseException as e:
+			warnlog(f"Download lane {self._thread.name} stopped: {e!r}")
+			with self._cond:
+				self.dead = True
+				requests = list(self._active.values()) + self._starting + self._pending
+				self._active.clear()
+				self._paused.clear()
+				self._starting = []
+				self._pending = []
+			for req in requests:
+				self._fail(req, f"download lane failed: {e!r}")
+
+	def _loop(self):
+		while True:
+			with self._cond:
+				while not self._active and not self._pending:
+					self._cond.wait()
+				self._starting, self._pending = self._pending, []
+
+			while self._starting:
+				req = self._starting.pop(0)
+				try:
+					c = self._make_handle(req)
+				except pycurl.error as e:
+					req.error = e.args
+					req._done.set()
+					continue
+				self._active[c] = req
+				self._multi.add_handle(c)
+
+			self._update_low_speed_limits()
+			if self._paused:
+				self._resume_paused()
+
+			while True:
+				ret, _ = self._multi.perform()
+				if ret != pycurl.E_CALL_MULTI_PERFORM:
+					break
+
+			while True:
+				queued, ok_list, err_list = self._multi.info_read()
+				for c in ok_list:
+					self._finish(c, None)
+				for c, errno, errmsg in err_list:
+					self._finish(c, (errno, errmsg))
+				if queued == 0:
+					break
+
+			if self._active:
+				self._multi.select(self.SELECT_TIMEOUT)
+
+
+class DownloadEngine:
+	"""
+	Process-wide HTTP download engine based on `pycurl.CurlMulti`.
+	Connections are kept alive between requests and multiplexed over HTTP/2
+	where the server supports it. DNS and TLS session caches are shared.
+
+	The write callbacks run on the lane threads, so CPU-heavy work
+	(decompression, hashing) is spread over `lanes` threads.
+	"""
+	def __init__(self, max_connections: int, lanes: int = 1):
+		self.connections_per_lane = max(1, max_connections // lanes)
+		self.share = pycurl.CurlShare()
+		self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+		self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+		self._lock = threading.Lock()
+		self._lanes = [_DownloadLane(self, i) for i in range(lanes)]
+
+	def submit(self, req: DownloadRequest) -> DownloadRequest:
+		with self._lock:
+			lanes = [lane for lane in self._lanes if not lane.dead]
+			if not lanes:
+				# Every lane crashed. Start over rather than failing all downloads.
+				self._lanes = lanes = [_DownloadLane(self, i) for i in range(len(self._lanes))]
+			lane = min(lanes, key=lambda lane: lane.load())
+		lane.submit(req)
+		return req
+
+	def fetch(self, url: str, on_data, byte_range: str | None = None, monitor = None,
+			limiters: list[RateLimiter] | None = None) -> DownloadRequest:
+		"""
+		Blocking download. Check `error` and `response_code` of the returned request.
+		"""
+		return self.submit(DownloadRequest(url, on_data, byte_range, monitor, limiters)).wait()
+
+
+_download_engine: DownloadEngine | None = None
+_download_engine_lock = threading.Lock()
+
+def get_download_engine() -> DownloadEngine:
+	"""
+	Returns the download engine shared by all clients and worker threads
+	"""
+	global _download_engine
+	with _download_engine_lock:
+		if _download_engine is None:
+			_download_engine = DownloadEngine(DOWNLOAD_CONNECTIONS, DOWNLOAD_LANES)
+		return _download_engine
+
+
+class AdaptiveConcurrency:
+	"""
+	AIMD controller for the number of chunk requests in flight.
+	Finished requests are reported by the download engine (`DownloadRequest.monitor`).
+	Once per `INTERVAL`, the limit is
+	* lowered by `DECREASE_FACTOR` on server/network errors or if the time to
+	  the first byte rises far above the best observed value (congestion),
+	* raised by one if all slots were in use and the throughput did not drop.
+	"""
+	INTERVAL = 1.0 # seconds
+	DECREASE_FACTOR = 0.75
+	LATENCY_FACTOR = 3.0
+
+	def __init__(self, minimum: int, maximum: int, initial: int, on_change = None):
+		self.minimum = max(1, minimum)
+		self.maximum = max(self.minimum, maximum)
+		self.limit = min(self.maximum, max(self.minimum, initial))
+		self.throughput = 0.0 # bytes/s of the last interval
+		self.on_change = on_change # on_change(limit, throughput)
+		self._inflight = 0
+		self._saturated = False
+		self._bytes = 0
+		self._errors = 0
+		self._latencies: list[float] = []
+		self._base_latency: float | None = None
+		self._window_start = time.monotonic()
+		self._cond = threading.Condition()
+
+	def acquire(self):
+		with self._cond:
+			while self._inflight >= self.limit:
+				self._cond.wait()
+			self._inflight += 1
+			if self._inflight >= self.limit:
+				self._saturated = True
+
+	def release(self):
+		with self._cond:
+			self._inflight -= 1
+			self._cond.notify()
+
+	def request_done(self, req: DownloadRequest):
+		# Only count errors that indicate an overloaded server or link
+		errno = req.error[0] if req.error else 0
+		congested = errno not in (0, pycurl.E_WRITE_ERROR, pycurl.E_HTTP_RETURNED_ERROR) \
+			or req.response_code == 429 or req.response_code >= 500
+		changed = None
+		with self._cond:
+			self._bytes += req.bytes_received
+			if congested:
+				self._errors += 1
+			elif not req.error:
+				self._latencies.append(req.ttfb)
+			if time.monotonic() - self._window_start >= self.INTERVAL:
+				changed = self._adjust()
+		if changed is not None and self.on_change:
+			self.on_change(changed, self.throughput)
+
+	def _adjust(self) -> int | None:
+		"""
+		Closes the current measurement window. Returns the new limit if it changed.
+		"""
+		now = time.monotonic()
+		throughput = self._bytes / (now - self._window_start)
+		latency = statistics.median(self._latencies) if self._latencies else None
+		if latency is not None:
+			# Slowly forget old minimums (route changes)
+			self._base_latency = latency if self._base_latency is None \
+				else min(latency, self._base_latency * 1.05)
+
+		old = self.limit
+		if self._errors > 0 or (latency is not None and latency > self.LATENCY_FACTOR * max(self._base_latency, 0.005)):
+			self.limit = max(self.minimum, int(self.limit * self.DECREASE_FACTOR))
+		elif self._saturated and throughput >= 0.9 * self.throughput:
+			self.limit = min(self.maximum, self.limit + 1)
+
+		self.throughput = throughput
+		self._bytes = 0
+		self._errors = 0
+		self._latencies.clear()
+		self._window_start = now
+		self._saturated = self._inflight >= self.limit
+		if self.limit == old:
+			return None
+		self._cond.notify_all()
+		return self.limit
+
+
+# ------------------- Background priority
+
+# setpriority(2) on macOS: throttles CPU and I/O of the calling thread
+PRIO_DARWIN_THREAD = 3
+PRIO_DARWIN_BG = 0x1000
+# Linux fallback: nice value and ioprio_set(2) idle class of the calling thread
+BACKGROUND_NICE = 10
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+SYS_IOPRIO_SET = { "x86_64": 251, "aarch64": 30 }.get(os.uname().machine)
+
+if sys.platform == "darwin":
+	c_setpriority = libc.setpriority
+	c_setpriority.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_int]
+	c_setpriority.restype = ctypes.c_int
+	c_syscall = None
+else:
+	c_setpriority = None
+	c_syscall = getattr(libc, "syscall", None)
+	if c_syscall is not None:
+		c_syscall.argtypes = [ctypes.c_long, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+		c_syscall.restype = ctypes.c_long
+
+def enter_background_priority():
+	"""
+	Lowers the CPU and I/O priority of the calling thread. Best effort.
+	Threads started afterwards must call this on their own.
+	"""
+	if c_setpriority is not None:
+		if c_setpriority(PRIO_DARWIN_THREAD, 0, PRIO_DARWIN_BG) != 0:
+			debuglog("Cannot enter the background priority")
+		return
+
+	tid = threading.get_native_id()
+	try:
+		os.setpriority(os.PRIO_PROCESS, tid, BACKGROUND_NICE) # per thread on Linux
+	except (AttributeError, OSError) as e:
+		debuglog(f"Cannot lower the CPU priority: {e}")
+	if SYS_IOPRIO_SET is not None and c_syscall is not None:
+		if c_syscall(SYS_IOPRIO_SET, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << 13) != 0:
+			debuglog(f"Cannot lower the I/O priority: {os.strerror(ctypes.get_errno())}")
+
+
+class LoadGovernor:
+	"""
+	Limits the number of busy workers of a background task.
+	Once per `INTERVAL`, the limit is halved if other processes keep the CPUs
+	busy or the disks are saturated, and raised by one while the system is idle.
+	"""
+	INTERVAL = 1.0 # seconds
+	CPU_BUSY = 50.0 # % of all cores, used by other processes
+	CPU_IDLE = 20.0
+	DISK_BUSY = 0.9 # fraction of the time with disk requests in progress
+
+	def __init__(self, minimum: int, maximum: int, initial: int | None = None):
+		self.minimum = max(1, minimum)
+		self.maximum = max(self.minimum, maximum)
+		self.limit = min(self.maximum, max(self.minimum, initial if initial is not None else self.maximum // 2))
+		self._busy = 0
+		self._cond = threading.Condition()
+		self._process = psutil.Process()
+		# Samples of the previous window. Kept here, since `psutil.cpu_percent(None)`
+		# measures per calling thread and `_adjust` runs on any worker.
+		self._cpu_times = self._system_cpu_times()
+		self._own_time = self._process_cpu_time()
+		self._disk_time = self._disk_busy_time()
+		self._window_start = time.monotonic()
+
+	@staticmethod
+	def _system_cpu_times() -> tuple[float, float]:
+		"""
+		Returns the (busy, total) CPU seconds of all cores since boot
+		"""
+		t = psutil.cpu_times()
+		# Linux: guest time is included in user and nice already
+		total = sum(t) - getattr(t, "guest", 0.0) - getattr(t, "guest_nice", 0.0)
+		return total - t.idle - getattr(t, "iowait", 0.0), total
+
+	def _process_cpu_time(self) -> float:
+		t = self._process.cpu_times()
+		return t.user + t.system
+
+	@staticmethod
+	def _disk_busy_time() -> float | None:
+		"""
+		Returns the summed time (ms) spent on disk requests, or `None` if unknown
+		"""
+		try:
+			io = psutil.disk_io_counters()
+		except (OSError, RuntimeError):
+			return None
+		if io is None:
+			return None
+		return getattr(io, "busy_time", io.read_time + io.write_time)
+
+	def acquire(self):
+		with self._cond:
+			self._adjust()
+			while self._busy >= self.limit:
+				self._cond.wait(self.INTERVAL)
+				self._adjust()
+			self._busy += 1
+
+	def release(self):
+		with self._cond:
+			self._busy -= 1
+			self._cond.notify()
+
+	def _adjust(self):
+		now = time.monotonic()
+		elapsed = now - self._window_start
+		if elapsed < self.INTERVAL:
+			return
+		busy, total = self._system_cpu_times()
+		own_time = self._process_cpu_time()
+		total_delta = total - self._cpu_times[1]
+		others = 0.0
+		if total_delta > 0:
+			# % of all cores
+			others = max(0.0, busy - self._cpu_times[0] - (own_time - self._own_time)) * 100 / total_delta
+		self._cpu_times = (busy, total)
+		self._own_time = own_time
+		disk_time = self._disk_busy_time()
+		disk = 0.0
+		if disk_time is not None and self._disk_time is not None:
+			disk = (disk_time - self._disk_time) / (elapsed * 1000)
+		self._disk_time = disk_time
+		self._window_start = now
+
+		old = self.limit
+		if others > self.CPU_BUSY or disk >= self.DISK_BUSY:
+			self.limit = max(self.minimum, self.limit // 2)
+		elif others < self.CPU_IDLE:
+			self.limit = min(self.maximum, self.limit + 1)
+		if self.limit != old:
+			debuglog(f"Background workers: {self.limit} (other processes: {others:.0f} % CPU, disk busy: {disk:.0%})")
+			self._cond.notify_all()
+
+
+# ------------------- Temp space
+
+class TempSpaceGovernor:
+	"""
+	Keeps track of the disk space reserved by downloads in progress, i.e. files
+	assembled in `tempdir` and ldiff files.
+	`reserve()` blocks while the reservation would exceed `budget` or the free
+	disk space. Work that holds a reservation releases it when done, which lets
+	the waiting threads continue. Thus, a nearly full disk slows down the
+	download instead of failing it.
+
+	Persistent reservations (ldiff files kept until the update finishes) count
+	towards the limits, but nobody waits for them to be released.
+	"""
+	POLL_INTERVAL = 1.0 # seconds. The free disk space may change by other means
+
+	def __init__(self, budget: int | None = None):
+		self.budget = budget # bytes. None: limited by the free disk space only
+		self._transient = 0
+		self._persistent = 0
+		self._cond = threading.Condition()
+
+	def _fits(self, nbytes: int, path: pathlib.Path) -> bool:
+		if self.budget is not None and self._transient + self._persistent + nbytes > self.budget:
+			return False
+		# Conservative: assume that nothing of the transient reservations was written yet.
+		# Persistent ones are (mostly) on the disk already.
+		return shutil.disk_usage(path).free - self._transient - nbytes >= DISK_SPACE_MARGIN
+
+	def reserve(self, nbytes: int, path: pathlib.Path, persistent: bool = False, cancel_event = None) -> bool:
+		"""
+		Waits until `nbytes` can be stored below `path`.
+		If nothing else is waiting to be released, the reservation is granted
+		regardless, so that an oversized file cannot block forever.
+		Returns `False` if cancelled.
+		"""
+		warned = False
+		with self._cond:
+			while not self._fits(nbytes, path) and self._transient > 0:
+				if not warned:
+					warned = True
+					infolog(f"Waiting for temporary disk space ({bytes_to_MiB(nbytes)} MiB)")
+				if cancel_event and cancel_event.is_set():
+					return False
+				self._cond.wait(self.POLL_INTERVAL)
+
+			if not self._fits(nbytes, path):
+				warnlog(f"Temporary space exceeded by a single file ({bytes_to_MiB(nbytes)} MiB below '{path}'). Continuing.")
+			if persistent:
+				self._persistent += nbytes
+			else:
+				self._transient += nbytes
+		return True
+
+	def release(self, nbytes: int, persistent: bool = False):
+		with self._cond:
+			if persistent:
+				self._persistent = max(0, self._persistent - nbytes)
+			else:
+				self._transient = max(0, self._transient - nbytes)
+			self._cond.notify_all()
+
+# Shared by all clients, since they write to the same disks
+temp_space = TempSpaceGovernor(TEMP_SPACE_BUDGET)
+
+
+# ------------------- Chunk store
+
+class ChunkStore:
+	"""
+	Content-addressed storage for compressed chunks, shared by all files and categories.
+	Chunks are stored as `<root>/<first 2 chars of chunk_id>/<chunk_id>`.
+
+	`plan()` counts how many pending files reference each chunk. Chunks that are
+	referenced more than once are kept after their first download and removed
+	once the last referencing file was released with `release()`.
+	"""
+	def __init__(self, root: pathlib.Path):
+		self.root = root
+		self.bytes_saved = 0 # compressed bytes that were not downloaded again
+		self._refs: dict[str, int] = {}
+		self._planned: set[str] = set() # file names
+		self._locks: dict[str, threading.Lock] = {}
+		self._lock = threading.Lock()
+
+	def path(self, chunk_id: str) -> pathlib.Path:
+		return self.root / chunk_id[:2] / chunk_id
+
+	def plan(self, files, fetched = None) -> tuple[int, list[manifest_pb2.FileInfo]]:
+		"""
+		Adds the chunk references of `files`. Files with the same md5 as an
+		earlier file are not counted, since they are copied instead.
+		fetched: (optional) `fetched(file_info)` returns `False` for files that are
+		         not downloaded (e.g. already installed). These neither hold chunks
+		         nor serve as the source of a copy.
+		Returns (bytes saved by deduplication, list of duplicate files)
+		"""
+		saved = 0
+		duplicates = []
+		seen_md5 = set()
+		with self._lock:
+			seen_chunks = set(self._refs)
+			for v in files:
+				if v.flags != 0 or v.filename in self._planned:
+					continue
+				if fetched is not None and not fetched(v):
+					continue
+				if v.size > 0 and v.md5 in seen_md5:
+					duplicates.append(v)
+					saved += sum(c.compressed_size for c in v.chunks)
+					continue
+				seen_md5.add(v.md5)
+				self._planned.add(v.filename)
+				for c in v.chunks:
+					if c.chunk_id in seen_chunks:
+						saved += c.compressed_size
+					seen_chunks.add(c.chunk_id)
+					self._refs[c.chunk_id] = self._refs.get(c.chunk_id, 0) + 1
+		return saved, duplicates
+
+	def cached_ids(self) -> set[str]:
+		"""
+		Returns the IDs of all chunks that are stored
+		"""
+		cached = set()
+		if self.root.is_dir():
+			for subdir in os.scandir(self.root):
+				if subdir.is_dir():
+					cached.update(entry.name for entry in os.scandir(subdir.path) if entry.is_file())
+		return cached
+
+	def is_shared(self, chunk_id: str) -> bool:
+		"""
+		Returns `True` if the chunk is still needed by more than one file
+		"""
+		with self._lock:
+			return self._refs.get(chunk_id, 0) > 1
+
+	def chunk_lock(self, chunk_id: str) -> threading.Lock:
+		"""
+		Serializes the download of a shared chunk
+		"""
+		with self._lock:
+			lock = self._locks.get(chunk_id)
+			if lock is None:
+				lock = self._locks[chunk_id] = threading.Lock()
+			return lock
+
+	def add_saved(self, nbytes: int):
+		with self._lock:
+			self.bytes_saved += nbytes
+
+	def release(self, file_info: manifest_pb2.FileInfo):
+		"""
+		Drops the references of a finished (or failed) file. Removes chunks
+		that are no longer needed.
+		"""
+		remove = []
+		with self._lock:
+			if file_info.filename in self._planned:
+				self._planned.remove(file_info.filename)
+				for c in file_info.chunks:
+					n = self._refs.get(c.chunk_id, 0) - 1
+					if n > 0:
+						self._refs[c.chunk_id] = n
+						continue
+					self._refs.pop(c.chunk_id, None)
+					remove.append(c.chunk_id)
+			else:
+				remove = [c.chunk_id for c in file_info.chunks if c.chunk_id not in self._refs]
+			for chunk_id in remove:
+				self._locks.pop(chunk_id, None)
+		for chunk_id in remove:
+			path = self.path(chunk_id)
+			path.unlink(missing_ok=True)
+			try:
+				path.parent.rmdir() # only if empty
+			except OSError:
+				pass
+
+
+def clone_file(src: pathlib.Path, dst: pathlib.Path):
+	"""
+	Copies `src` to `dst`. Uses a copy-on-write clone if the file system supports it.
+	"""
+	dst.unlink(missing_ok=True)
+	if c_clonefile is not None:
+		if c_clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+			return
+	shutil.copyfile(src, dst)
+
+
+# ------------------- Chunk scheduler
+
+class _FileJob:
+	"""
+	Download state of one file in `ChunkScheduler`
+	"""
+	def __init__(self, file_info: manifest_pb2.FileInfo, in_place: bool = False,
+			base: pathlib.Path | None = None):
+		self.file_info = file_info
+		self.name = pathlib.Path(file_info.filename).name
+		self.in_place = in_place # write into the damaged game file
+		self.base = base # (optional) outdated game file to start the temporary file from
+		self.check_chunks = in_place or base is not None # skip chunks whose data is already correct
+		self.dstfile = gamedir(file_info.filename) if in_place else download_temp_path(file_info.filename)
+		self.fd: int | None = None
+		self.hash: IncrementalMD5 | None = None
+		self.chunks_left = len(file_info.chunks)
+		self.bytes_written = 0
+		self.bytes_downloaded = 0 # compressed
+		self.attempts = 0
+		self.reserved = 0 # bytes of `temp_space`
+		self.failed = False
+		self.done = False
+		self.twins: list[manifest_pb2.FileInfo] = [] # files with identical contents
+		self.lock = threading.Lock()
+
+	def open(self) -> int:
+		with self.lock:
+			if self.fd is None:
+				if self.in_place or self.base is not None:
+					if self.base is not None:
+						clone_file(self.base, self.dstfile)
+						self.base = None # once only. Retries continue with the copy
+					self.fd = os.open(self.dstfile, os.O_RDWR)
+					if os.fstat(self.fd).st_size != self.file_info.size:
+						os.ftruncate(self.fd, self.file_info.size)
+				else:
+					self.fd = os.open(self.dstfile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+				self.hash = IncrementalMD5(self.fd)
+			return self.fd
+
+	def close(self):
+		with self.lock:
+			if self.fd is not None:
+				os.close(self.fd)
+				self.fd = None
+
+
+class ChunkScheduler:
+	"""
+	Downloads many files through one shared queue of chunks.
+	Workers pull single chunks, thus a large file is spread over all workers
+	instead of keeping one of them busy until the end of the install.
+	Chunks are written with positional writes at `chunk.offset`. A file is
+	verified and moved into the game directory once its last chunk is written.
+	Files with the same md5 as a queued file are copied from it afterwards.
+	Damaged game files are repaired in place: only the chunks whose data does
+	not match `chunk.md5` are downloaded. Outdated game files are copied to the
+	temporary file first, which is then repaired the same way.
+
+	Usage: `start()`, then `add_file()` as often as needed, then `finish()`.
+	"""
+	MAX_ATTEMPTS = 5 # per file
+
+	def __init__(self, cli: SophonClient, workers: int, progress_handler = None, cancel_event = None,
+			concurrency: AdaptiveConcurrency | None = None, load: LoadGovernor | None = None):
+		"""
+		concurrency: (optional) limits the chunks in flight. `workers` should be
+		             at least `concurrency.maximum`.
+		load:        (optional) limits the busy workers of a background task
+		"""
+		self.cli = cli
+		self.workers = workers
+		self.concurrency = concurrency
+		self.load = load
+		self.progress_handler = progress_handler
+		self.cancel_event = cancel_event
+		self._queue: collections.deque[tuple[_FileJob, manifest_pb2.ChunkInfo]] = collections.deque()
+		self._cond = threading.Condition()
+		self._jobs: list[_FileJob] = []
+		self._by_md5: dict[str, _FileJob] = {}
+		self._unfinished = 0
+		self._closed = False
+		self._cancelled = False
+		self._failed: list[str] = []
+		self._threads: list[threading.Thread] = []
+
+	def start(self):
+		for i in range(self.workers):
+			t = threading.Thread(target=self._worker, name=f"chunk-worker-{i}", daemon=True)
+			t.start()
+			self._threads.append(t)
+
+	def add_file(self, file_info: manifest_pb2.FileInfo, damaged: bool = False, outdated: bool = False) -> bool:
+		"""
+		Queues all chunks of a file. Returns `False` if the file is skipped.
+		damaged:  the game file is known to be corrupt. It is downloaded even if the
+		          size matches, and repaired in place if `OPT.repair_in_place`.
+		outdated: the game file is of an older version. It is downloaded even if the
+		          size matches. Its unchanged chunks are reused, but the game file is
+		          only replaced once the new file is complete.
+		"""
+		if not self.cli._check_file_download_needed(file_info, self.progress_handler, damaged or outdated):
+			self.cli.chunk_store.release(file_info)
+			return False
+
+		exists = file_info.size > 0 and gamedir(file_info.filename).is_file()
+		in_place = damaged and OPT.repair_in_place and not OPT.dry_run and exists
+		if not in_place and file_info.size > 0 and self._add_twin(file_info):
+			return True
+
+		base = gamedir(file_info.filename) if outdated and not in_place and exists else None
+		job = _FileJob(file_info, in_place, base)
+		# Space for the assembled file, plus the compressed chunks if they are cached
+		reserve = 0 if in_place else file_info.size
+		if not OPT.stream_chunks:
+			reserve += sum(c.compressed_size for c in file_info.chunks)
+		if not temp_space.reserve(reserve, OPT.tempdir, cancel_event=self.cancel_event):
+			with self._cond:
+				self._cancelled = True
+			return False
+		job.reserved = reserve
+
+		infolog(f"Queued '{job.name}', {bytes_to_MiB(file_info.size)} MiB, {len(file_info.chunks)} chunks")
+		if self.progress_handler:
+			self.progress_handler.chunk_download_progress(job.name, len(file_info.chunks), 0, 0.0, 0, file_info.size, 0)
+
+		# File was already downloaded but not moved (e.g. out of space)
+		complete = (not in_place and try_get_file_size(job.dstfile) == file_info.size) or job.chunks_left == 0
+		with self._cond:
+			self._jobs.append(job)
+			self._by_md5.setdefault(file_info.md5, job)
+			self._unfinished += 1
+			if not complete:
+				self._queue.extend((job, chunk) for chunk in file_info.chunks)
+				self._cond.notify_all()
+
+		if complete:
+			if job.chunks_left == 0:
+				job.open() # create empty file
+			self._finalize(job)
+		return True
+
+	def _add_twin(self, file_info: manifest_pb2.FileInfo) -> bool:
+		"""
+		Attaches a file to a queued file with identical contents.
+		Returns `False` if there is none.
+		"""
+		with self._cond:
+			primary = self._by_md5.get(file_info.md5)
+			if primary is None or primary.file_info.size != file_info.size:
+				return False
+			self._unfinished += 1
+		with primary.lock:
+			if not primary.done:
+				primary.twins.append(file_info)
+				infolog(f"Queued '{pathlib.Path(file_info.filename).name}' as copy of '{primary.name}'")
+				return True
+		if primary.failed:
+			self._fail_twin(file_info, f"same as failed '{primary.name}'")
+		else:
+			self._copy_twin(primary, file_info)
+		return True
+
+	def _copy_twin(self, primary: _FileJob, file_info: manifest_pb2.FileInfo):
+		src = primary.dstfile if OPT.dry_run else gamedir(primary.file_info.filename)
+		dstfile = download_temp_path(file_info.filename)
+		try:
+			clone_file(src, dstfile)
+			ok = self.cli._finish_game_file(file_info, dstfile, self.progress_handler, file_info.md5)
+			assert ok
+		except Exception as e:
+			self._fail_twin(file_info, f"copy of '{primary.name}' failed: {e}")
+			return
+		self.cli.chunk_store.add_saved(sum(c.compressed_size for c in file_info.chunks))
+		with self._cond:
+			self._unfinished -= 1
+			self._cond.notify_all()
+
+	def _fail_twin(self, file_info: manifest_pb2.FileInfo, reason: str):
+		if self.progress_handler:
+			self.progress_handler.file_download_error(pathlib.Path(file_info.filename).name, reason)
+		with self._cond:
+			self._failed.append(file_info.filename)
+			self._unfinished -= 1
+			self._cond.notify_all()
+
+	def finish(self):
+		"""
+		Waits for all queued files. Raises an exception if any file failed.
+		"""
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+		for t in self._threads:
+			t.join()
+		for job in self._jobs:
+			job.close()
+			self._release_space(job)
+		print("") # Keep the last "100 %" line
+
+		if self._cancelled:
+			if self.progress_handler:
+				self.progress_handler.job_error("cancelled")
+			raise Exception("Download cancelled")
+		if self._failed:
+			abortlog(f"Failed to download {len(self._failed)} file(s): " + ", ".join(self._failed))
+
+	def _next(self) -> tuple[_FileJob, manifest_pb2.ChunkInfo] | None:
+		with self._cond:
+			while not self._queue and not self._cancelled \
+					and not (self._closed and self._unfinished == 0):
+				self._cond.wait()
+			if self._cancelled or not self._queue:
+				return None
+			return self._queue.popleft()
+
+	def _worker(self):
+		if OPT.background:
+			enter_background_priority()
+		while True:
+			# Take a chunk first: idle workers must not hold slots, or the
+			# concurrency controller takes them for chunks in flight
+			item = self._next()
+			if item is None:
+				return
+			if self.load:
+				self.load.acquire()
+			if self.concurrency:
+				self.concurrency.acquire()
+			try:
+				if not self._process(*item):
+					return
+			finally:
+				if self.concurrency:
+					self.concurrency.release()
+				if self.load:
+					self.load.release()
+
+	def _process(self, job: _FileJob, chunk: manifest_pb2.ChunkInfo) -> bool:
+		"""
+		Writes one chunk. Returns `False` if the download was cancelled.
+		"""
+		if job.failed:
+			return True
+
+		if self.cancel_event and self.cancel_event.is_set():
+			with self._cond:
+				self._cancelled = True
+				self._queue.clear()
+				self._cond.notify_all()
+			return False
+
+		downloaded = chunk.compressed_size
+		try:
+			fd = job.open()
+			if job.check_chunks and chunk_intact(fd, chunk):
+				job.hash.complete(chunk.offset, chunk.uncompressed_size)
+				nbytes = chunk.uncompressed_size
+				downloaded = 0
+			else:
+				nbytes = self.cli._write_chunk(fd, chunk, job.hash)
+		except Exception as e:
+			self._retry_or_fail(job, [(job, chunk)], f"chunk {chunk.chunk_id}: {e}")
+			return True
+
+		with job.lock:
+			job.chunks_left -= 1
+			job.bytes_written += nbytes
+			job.bytes_downloaded += downloaded
+			done = (job.chunks_left == 0)
+			bytes_written = job.bytes_written
+
+		size = job.file_info.size
+		debuglog(f"\t Progress: {(bytes_written * 100 / size):2.0f} % | "
+		         + f" {bytes_to_MiB(bytes_written)} / {bytes_to_MiB(size)} MiB | {job.name}", end="\r")
+		if self.progress_handler:
+			self.progress_handler.chunk_download_progress(
+				job.name, len(job.file_info.chunks), chunk.chunk_id, bytes_written * 100 / size, bytes_written, size, downloaded)
+
+		if done:
+			self._finalize(job)
+		return True
+
+	def _release_space(self, job: _FileJob):
+		with job.lock:
+			nbytes, job.reserved = job.reserved, 0
+		if nbytes > 0:
+			temp_space.release(nbytes)
+
+	def _finalize(self, job: _FileJob):
+		md5 = job.hash.hexdigest(job.file_info.size) if job.hash else None
+		job.close()
+		try:
+			ok = self.cli._finish_game_file(job.file_info, job.dstfile, self.progress_handler, md5, job.in_place)
+		except Exception as e:
+			self._fail(job, str(e))
+			return
+
+		if ok:
+			if job.in_place:
+				infolog(f"\t Repaired '{job.name}' in place, downloaded {bytes_to_MiB(job.bytes_downloaded)} MiB")
+			self._release_space(job)
+			with job.lock:
+				job.done = True
+				twins, job.twins = job.twins, []
+			for file_info in twins:
+				self._copy_twin(job, file_info)
+			with self._cond:
+				self._unfinished -= 1
+				self._cond.notify_all()
+			return
+
+		# Corrupt. Download the entire file again.
+		with job.lock:
+			job.chunks_left = len(job.file_info.chunks)
+			job.bytes_written = 0
+			job.hash = None
+			job.check_chunks = False
+			job.base = None
+		self._retry_or_fail(job, [(job, c) for c in job.file_info.chunks], "md5 mismatch")
+
+	def _retry_or_fail(self, job: _FileJob, items: list, reason: str):
+		with job.lock:
+			job.attempts += 1
+			attempts = job.attempts
+		if attempts >= self.MAX_ATTEMPTS:
+			self._fail(job, reason)
+			return
+
+		warnlog(f"Retrying '{job.name}' ({attempts}/{self.MAX_ATTEMPTS}): {reason}")
+		with self._cond:
+			self._queue.extend(items)
+			self._cond.notify_all()
+
+	def _fail(self, job: _FileJob, reason: str):
+		with job.lock:
+			if job.failed:
+				return
+			job.failed = True
+			job.done = True
+			twins, job.twins = job.twins, []
+		self.cli.chunk_store.release(job.file_info)
+		self._release_space(job)
+		if self.progress_handler:
+			self.progress_handler.file_download_error(job.name, reason)
+		with self._cond:
+			self._failed.append(job.file_info.filename)
+			self._unfinished -= 1
+			self._cond.notify_all()
+		for file_info in twins:
+			self._fail_twin(file_info, f"same as failed '{job.name}'")
+
+
+# ------------------- Update planning
+
+class UpdatePlanEntry:
+	"""
+	Planned update method of one modified file and the estimated costs of both methods
+	method: "ldiff" (apply the patch) or "chunks" (download the new file)
+	chunk_bytes: compressed chunks that are not cached yet, -1 if the file has no chunks
+	"""
+	def __init__(self, filename: str, patch_bytes: int, patch_seconds: float,
+			chunk_bytes: int, chunk_seconds: float):
+		self.filename = filename
+		self.method = "ldiff"
+		self.patch_bytes = patch_bytes
+		self.patch_seconds = patch_seconds # CPU time
+		self.chunk_bytes = chunk_bytes
+		self.chunk_seconds = chunk_seconds # CPU time
+
+	def cost(self, method: str, download_rate: float) -> float:
+		"""
+		Estimated seconds to update the file with `method`
+		"""
+		if method == "ldiff":
+			return self.patch_bytes / download_rate + self.patch_seconds
+		return self.chunk_bytes / download_rate + self.chunk_seconds
+
+
+class UpdatePlan:
+	"""
+	Result of `SophonClient.plan_update`: the update method of each modified file
+	"""
+	def __init__(self, download_rate: float):
+		self.download_rate = download_rate # bytes/s, assumed
+		self.entries: dict[str, UpdatePlanEntry] = {} # filename -> entry
+
+	def add(self, entry: UpdatePlanEntry):
+		if entry.chunk_bytes >= 0 and entry.cost("chunks", self.download_rate) < entry.cost("ldiff", self.download_rate):
+			entry.method = "chunks"
+		self.entries[entry.filename] = entry
+
+	def method(self, filename: str) -> str | None:
+		entry = self.entries.get(filename)
+		return entry.method if entry else None
+
+	def count(self, method: str) -> int:
+		return sum(1 for entry in self.entries.values() if entry.method == method)
+
+	def download_bytes(self) -> int:
+		return sum(entry.patch_bytes if entry.method == "ldiff" else entry.chunk_bytes
+			for entry in self.entries.values())
+
+	def estimated_seconds(self) -> float:
+		"""
+		Download time plus CPU time, spread over the patch workers
+		"""
+		cpu = sum(entry.patch_seconds if entry.method == "ldiff" else entry.chunk_seconds
+			for entry in self.entries.values())
+		return self.download_bytes() / self.download_rate + cpu / LDIFF_PATCH_WORKER_CNT
+
+	def to_json(self) -> dict:
+		return {
+			"download_rate": self.download_rate,
+			"download_bytes": self.download_bytes(),
+			"estimated_seconds": self.estimated_seconds(),
+			"files": [vars(entry) for entry in self.entries.values()],
+		}
 
 
 # -------------------
@@ -324,11 +2148,29 @@ class SophonClient:
 
 	# chunks: For files to download from scratch
 	# diffs:  For files to update by patching or removal
-	di_chunks = DownloadInfo()
-	di_diffs  = DownloadInfo()
-
-	new_files_to_download = set() # Update only. Relative file name
-	ldiff_files_to_remove = set() # Update only. File name (no path)
+	di_chunks: DownloadInfo
+	di_diffs: DownloadInfo
+
+	chunk_store: ChunkStore | None = None
+	download_monitor: AdaptiveConcurrency | None = None # receives the results of all downloads
+	rate_limiter: RateLimiter | None = None # bandwidth limit of this client (task)
+	verify_index: VerifyIndex | None = None
+
+	new_files_to_download: set[str] # Update only. Relative file name
+	outdated_files: set[str] # Update only. Subset of the above: existing files to overwrite
+	ldiff_files_to_remove: set[str] # Update only. File name (no path)
+	ldiff_space_reserved: dict[str, int] # Update only. ldiff file name -> bytes of `temp_space` held
+	ldiff_lock: threading.Lock # guards the ldiff bookkeeping above
+
+	def __init__(self):
+		# Per client: several clients (tasks) may run at the same time
+		self.di_chunks = DownloadInfo()
+		self.di_diffs  = DownloadInfo()
+		self.new_files_to_download = set()
+		self.outdated_files = set()
+		self.ldiff_files_to_remove = set()
+		self.ldiff_space_reserved = {}
+		self.ldiff_lock = threading.Lock()
 
 
 	def initialize(self, opts: Options):
@@ -356,6 +2198,9 @@ class SophonClient:
 
 		if OPT.dry_run:
 			infolog("Simulation mode is enabled.")
+		if OPT.background:
+			infolog("Background mode is enabled.")
+			enter_background_priority()
 
 		# Autodetection
 		if OPT.do_install:
@@ -364,6 +2209,8 @@ class SophonClient:
 			self._initialize_update()
 
 		OPT.tempdir.mkdir(exist_ok=True)
+		self.chunk_store = ChunkStore(tempdir("chunks"))
+		self.verify_index = VerifyIndex(tempdir("verify-index.jsonl"))
 
 		if not OPT.gamedir.is_dir():
 			abortlog("Game directory does not exist.")
@@ -664,6 +2511,9 @@ class SophonClient:
 		else:
 			assert False, "unhandled rel_type"
 
+		if OPT.api_host:
+			base_url = OPT.api_host + "/hyp/hyp-connect/api"
+
 		tail = f"game_ids[]={game_ids}&launcher_id={launcher_id}"
 
 		if not self.branches_json:
@@ -715,7 +2565,7 @@ class SophonClient:
 		assert not (url is None), f"Unhandled release type {self.rel_type}"
 
 		url = (
-				"https://" + url + "/downloader/sophon_chunk/api/" + api_file
+				(OPT.api_host or ("https://" + url)) + "/downloader/sophon_chunk/api/" + api_file
 				+ "?branch=" + self.branches_json["branch"]
 				+ "&package_id=" + self.branches_json["package_id"]
 				+ "&password=" + self.branches_json["password"]
@@ -863,6 +2713,18 @@ class SophonClient:
 		return download_size_total
 
 
+	def _build_tag(self) -> str | None:
+		"""
+		Returns the version of the files that are being installed
+		"""
+		return self.di_chunks.getBuild_json["data"]["tag"] if self.di_chunks.getBuild_json else None
+
+	def _download_limiters(self) -> list[RateLimiter]:
+		"""
+		Returns the bandwidth limits that apply to downloads of this client
+		"""
+		return [limiter for limiter in (self.rate_limiter, global_rate_limiter) if limiter is not None]
+
 	def _download_file_resume(self, url: str, dstfile: pathlib.Path, dstsize: int):
 		filesize = try_get_file_size(dstfile)
 		if filesize == dstsize:
@@ -875,156 +2737,350 @@ class SophonClient:
 				dstfile.unlink()
 				filesize = 0
 
+		engine = get_download_engine()
 		errCnt = 0
 		errLogs = []
 		while True: # run up to 5 times
-			buffer = BytesIO()
-			c = pycurl.Curl()
-			c.setopt(c.URL, url)
-			if filesize > 0:
-				c.setopt(c.RANGE, f"{filesize}-")
-			c.setopt(c.WRITEDATA, buffer)
-
-			response_code = None
-			try:
-				c.perform()
-				response_code = c.getinfo(c.RESPONSE_CODE)
-				c.close()
+			# Resume from whatever the previous attempt managed to write
+			filesize = max(0, try_get_file_size(dstfile))
+			with dstfile.open("ab") as fh:
+				req = engine.fetch(url, fh.write, f"{filesize}-" if filesize > 0 else None,
+					self.download_monitor, self._download_limiters())
+
+			if req.response_code == 416:
+				# 416: Out of range. Our _tmp file is already complete.
+				infolog(f"File '{dstfile.name}' is already downloaded.")
+				return
+			if not req.error:
+				return
 
-				if response_code == 416:
-					# 416: Out of range. Our _tmp file is already complete.
-					infolog(f"File '{dstfile.name}' is already downloaded.")
-					return
+			errno, errstr = req.error
+			errCnt += 1
+			errLogs.append(f"Error {errno}: {errstr}")
+			if errCnt >= 5:
+				abortlog(f"Cannot download file '{dstfile.name}': " + ", ".join(errLogs))
+			warnlog(f"Error {errno}: {errstr}. Retrying ({errCnt}/5)...")
+			time.sleep(10)
 
-				break
-			except pycurl.error as e:
-				errno, errstr = e.args
-				errCnt += 1
-				errLogs.append(f"Error {errno}: {errstr}")
-				if errCnt >= 5:
-					abortlog(f"Cannot download file '{dstfile.name}': " + ", ".join(errLogs))
-				else:
-					warnlog(f"Error {errno}: {errstr}. Retrying ({errCnt}/5)...")
-					time.sleep(10)
-				return
+	def _download_chunk_streaming(self, url: str, fd: int, chunk: manifest_pb2.ChunkInfo,
+			file_hash: IncrementalMD5 | None = None, store_path: pathlib.Path | None = None) -> int:
+		"""
+		Downloads one chunk and decompresses it on the fly into `fd` at `chunk.offset`.
+		Neither the compressed nor the decompressed chunk is held in memory or on disk
+		as a whole.
+		file_hash: (optional) whole-file hash to update
+		store_path: (optional) also keep the compressed chunk in this file
 
-		with dstfile.open("ab") as fh:
-			fh.write(buffer.getvalue())
+		The chunk checksums are computed on the fly. On mismatch, only this
+		chunk is downloaded again.
 
-	def download_game_file(self, file_info: manifest_pb2.FileInfo, install_progress_handler = None, cancel_event = None):
+		Returns the number of uncompressed bytes written.
 		"""
-		Downloads the chunks and patches a file
-		file_info: FileInfo, one of the manifest.files[] objects
+		engine = get_download_engine()
+		errCnt = 0
+		errLogs = []
+		while True: # run up to 5 times
+			file_hasher = file_hash.begin(chunk.offset) if file_hash else None
+			chunk_xxh, chunk_md5 = chunk_hashers(chunk)
+			writer = PositionalWriter(fd, chunk.offset, file_hasher, chunk_md5)
+			decompressor = zstandard.ZstdDecompressor().stream_writer(writer, closefd=False)
+			store_part = store_path.with_name(store_path.name + ".part") if store_path else None
+			store_fh = store_part.open("wb") if store_part else None
+			cb_error = None
+
+			def on_data(data: bytes):
+				nonlocal cb_error
+				try:
+					if chunk_xxh:
+						chunk_xxh.update(data)
+					if store_fh:
+						store_fh.write(data)
+					decompressor.write(data)
+				except (zstandard.ZstdError, OSError) as e:
+					cb_error = e
+					return 0 # signals a write error to curl
+				return None
 
-		Returns `True` if the file is (now) present.
+			req = engine.fetch(url, on_data, monitor=self.download_monitor, limiters=self._download_limiters())
+			try:
+				req.raise_for_error()
+				decompressor.close()
+				if writer.bytes_written != chunk.uncompressed_size:
+					raise zstandard.ZstdError(f"got {writer.bytes_written} of {chunk.uncompressed_size} bytes")
+				verify_chunk_hashes(chunk, chunk_xxh, chunk_md5)
+				if store_fh:
+					store_fh.close()
+					os.replace(store_part, store_path)
+				if file_hash:
+					file_hash.complete(chunk.offset, writer.bytes_written, file_hasher)
+				return writer.bytes_written
+			except (pycurl.error, zstandard.ZstdError, ChecksumError, OSError) as e:
+				if cb_error:
+					e = cb_error
+				errCnt += 1
+				errLogs.append(f"{type(e).__name__}: {e}")
+				if errCnt >= 5:
+					abortlog(f"Cannot download chunk '{chunk.chunk_id}': " + ", ".join(errLogs))
+				warnlog(f"{errLogs[-1]}. Retrying ({errCnt}/5)...")
+				if not isinstance(e, ChecksumError):
+					time.sleep(10) # corrupt data is retried immediately
+			finally:
+				if store_fh:
+					store_fh.close()
+					# Incomplete or corrupt. Moved away if the chunk is correct.
+					store_part.unlink(missing_ok=True)
+
+	def _write_chunk_from_file(self, fd: int, chunk: manifest_pb2.ChunkInfo, cfname: pathlib.Path,
+			file_hash: IncrementalMD5 | None = None) -> int:
+		"""
+		Decompresses a downloaded chunk into `fd` at `chunk.offset`
+		Raises `ChecksumError` or `zstandard.ZstdError` if the chunk is corrupt.
 		"""
+		file_hasher = file_hash.begin(chunk.offset) if file_hash else None
+		chunk_xxh, chunk_md5 = chunk_hashers(chunk)
+		writer = PositionalWriter(fd, chunk.offset, file_hasher, chunk_md5)
+		decompressor = zstandard.ZstdDecompressor().stream_writer(writer, closefd=False)
+		with cfname.open("rb") as zfh:
+			while data := zfh.read(HASH_BUFFER_SIZE):
+				if chunk_xxh:
+					chunk_xxh.update(data)
+				decompressor.write(data)
+		decompressor.close()
+		if writer.bytes_written != chunk.uncompressed_size:
+			raise zstandard.ZstdError(f"got {writer.bytes_written} of {chunk.uncompressed_size} bytes")
+		verify_chunk_hashes(chunk, chunk_xxh, chunk_md5)
+		if file_hash:
+			file_hash.complete(chunk.offset, writer.bytes_written, file_hasher)
+		return writer.bytes_written
+
+	def _write_chunk(self, fd: int, chunk: manifest_pb2.ChunkInfo, file_hash: IncrementalMD5 | None = None) -> int:
+		"""
+		Fetches one chunk and writes it uncompressed into `fd` at `chunk.offset`
+		Chunks that are needed by other files too are kept in `self.chunk_store`.
+		file_hash: (optional) whole-file hash to update
+		Returns the number of bytes written.
+		"""
+		chunk_url = self.di_chunks.category_json["chunk_download"]["url_prefix"] + "/" + chunk.chunk_id
+		store = self.chunk_store
+		cfname = store.path(chunk.chunk_id) # compressed file path
+		if OPT.stream_chunks and not store.is_shared(chunk.chunk_id) and not cfname.is_file():
+			# Decompress directly into the destination file
+			return self._download_chunk_streaming(chunk_url, fd, chunk, file_hash)
+
+		with store.chunk_lock(chunk.chunk_id):
+			if try_get_file_size(cfname) == chunk.compressed_size:
+				# Downloaded before, by another file or a previous run
+				try:
+					size = self._write_chunk_from_file(fd, chunk, cfname, file_hash)
+					store.add_saved(chunk.compressed_size)
+					return size
+				except (ChecksumError, zstandard.ZstdError) as e:
+					warnlog(f"Discarding stored chunk: {e}")
+					cfname.unlink(missing_ok=True)
+
+			cfname.parent.mkdir(parents=True, exist_ok=True)
+			if OPT.stream_chunks:
+				return self._download_chunk_streaming(chunk_url, fd, chunk, file_hash, cfname)
+
+			for errCnt in range(1, 6):
+				# Download chunk if not already done
+				self._download_file_resume(chunk_url, cfname, chunk.compressed_size)
+				try:
+					size = self._write_chunk_from_file(fd, chunk, cfname, file_hash)
+					break
+				except (ChecksumError, zstandard.ZstdError) as e:
+					# The downloaded chunk is bad. Discard it and download again.
+					cfname.unlink(missing_ok=True)
+					if errCnt >= 5:
+						abortlog(f"Cannot download chunk '{chunk.chunk_id}': {e}")
+					warnlog(f"{e}. Retrying ({errCnt}/5)...")
+
+		if RUN_MEMORY_HACK:
+			force_memory_release()
+		return size
+
 
-		if install_progress_handler:
-			install_progress_handler.file_download_start(file_info.filename)
+	def _check_file_download_needed(self, file_info: manifest_pb2.FileInfo, progress_handler = None,
+			damaged: bool = False) -> bool:
+		"""
+		Checks that are common to all chunk downloads. Reports skipped files.
+		damaged: the game file is known to be corrupt, even if its size is correct
+		Returns `True` if the chunks of the file must be downloaded.
+		"""
+		if progress_handler:
+			progress_handler.file_download_start(file_info.filename)
 
 		if file_info.flags == 64:
 			# Created as soon a file is put inside
 			infolog(f"Skipping directory entry: {file_info.filename}")
-			if install_progress_handler:
-				install_progress_handler.file_download_skipped(file_info.filename, "directory")
+			if progress_handler:
+				progress_handler.file_download_skipped(file_info.filename, "directory")
 			return False
 		assert (file_info.flags == 0), f"Unknown flags {file_info.flags} for '{file_info.filename}'"
 
 		if OPT.TESTING_FILE and not (OPT.TESTING_FILE in file_info.filename):
-			return True
+			return False
 
 		filename_safety_check(file_info.filename)
-		filename = pathlib.Path(file_info.filename) # "UnityGame_Data/Subdirectory/file.txt"
 
 		# Check whether the file already exists
-		if try_get_file_size(gamedir(filename)) == file_info.size:
-			if install_progress_handler:
-				install_progress_handler.file_download_skipped(file_info.filename, "exists")
-			#infolog(f"File '{filename.name}' already exists. ")
-			return True
-
-		CHUNK_URL_PREFIX = self.di_chunks.category_json["chunk_download"]["url_prefix"]
-
-		# Inform the user
-		size_mib = bytes_to_MiB(file_info.size)
-		infolog(f"Downloading '{filename.name}', {size_mib} MiB, {len(file_info.chunks)} chunks")
-		if install_progress_handler:
-			install_progress_handler.chunk_download_progress(filename.name, len(file_info.chunks), 0, 0.0, 0, file_info.size, 0)
+		if not damaged and try_get_file_size(gamedir(file_info.filename)) == file_info.size:
+			if progress_handler:
+				progress_handler.file_download_skipped(file_info.filename, "exists")
+			return False
 
 		if OPT.disallow_download:
-			warnlog(f"NOT downloading chunks for {filename.name}")
-			return
-
-		# Download to the temporary directory. Move after we're done.
-		dstfile = tempdir(filename.name)
-		bytes_written = 0
-
-		while True: # run once
-			if try_get_file_size(dstfile) == file_info.size:
-				# File was already downloaded but not moved (e.g. out of space)
-				break
-
-			fh = dstfile.open("wb")
-			# Download all chunks
-			for chunk in file_info.chunks:
-				if cancel_event and cancel_event.is_set():
-					if install_progress_handler:
-						install_progress_handler.file_download_error(filename.name)
-					return False
-				cfname = tempdir(chunk.chunk_id) # compressed file path
-
-				if chunk.offset != bytes_written:
-					warnlog("\t Unexpected offset. Seek may fail.")
+			warnlog(f"NOT downloading chunks for {file_info.filename}")
+			return False
+		return True
 
-				# Download chunk if not already done
-				self._download_file_resume(CHUNK_URL_PREFIX + "/" + chunk.chunk_id, cfname, chunk.compressed_size)
-
-				# Write chunk to file
-				with cfname.open("rb") as zfh:
-					reader = zstandard.ZstdDecompressor().stream_reader(zfh)
-					data = reader.read()
-					fh.seek(chunk.offset)
-					fh.write(data)
-					bytes_written += len(data)
-
-				debuglog(f"\t Progress: {(bytes_written * 100 / file_info.size):2.0f} % | "
-				         + f" {bytes_to_MiB(bytes_written)} / {size_mib} MiB", end="\r")
-				if install_progress_handler:
-					install_progress_handler.chunk_download_progress(
-						filename.name, len(file_info.chunks), chunk.chunk_id, bytes_written * 100 / file_info.size, bytes_written, file_info.size, chunk.compressed_size)
-				del data, reader, zfh, cfname
 
-				if RUN_MEMORY_HACK:
-					force_memory_release()
-			print("") # Keep the last "100 %" line
+	def _finish_game_file(self, file_info: manifest_pb2.FileInfo, dstfile: pathlib.Path, progress_handler = None,
+			md5: str | None = None, in_place: bool = False) -> bool:
+		"""
+		Verifies a completely downloaded file and moves it to the game directory
+		md5: hash computed while writing the file. `None` to read the file again.
+		in_place: `dstfile` is the game file itself. It is neither moved nor removed.
+		Returns `False` and removes `dstfile` if the file is corrupt.
+		"""
+		filename = pathlib.Path(file_info.filename)
 
 		# Verify file integrity
-		md5 = hashlib.md5(dstfile.read_bytes()).hexdigest()
+		if md5 is None:
+			md5 = md5_file(dstfile)
 		if file_info.md5 == md5:
-			infolog("\t File is correct (md5 check)")
+			infolog(f"\t File is correct (md5 check): {filename.name}")
 		else:
-			dstfile.unlink() # delete
-			abortlog(f"\t File is corrupt after download: {filename.name}. Please retry.")
+			if not in_place:
+				dstfile.unlink() # delete
+			warnlog(f"\t File is corrupt after download: {filename.name}")
+			return False
 
 		if RUN_MEMORY_HACK:
 			force_memory_release()
 
-		# Remove chunks after downloading
-		for chunk in file_info.chunks:
-			tempdir(chunk.chunk_id).unlink(True)
+		# Remove chunks that are not needed by other files
+		self.chunk_store.release(file_info)
 
 		# Move the completed files to the game directory
 		if OPT.dry_run:
 			infolog(f"[move new '{filename.name}' -> game dir]")
 			return True
-		gamefile = gamedir(filename).resolve()
-		gamefile.parent.mkdir(parents=True, exist_ok=True)
-		shutil.move(dstfile, gamefile)
-		if install_progress_handler:
-			install_progress_handler.file_download_complete(filename.name, file_info.size)
+		if not in_place:
+			gamefile = gamedir(filename).resolve()
+			gamefile.parent.mkdir(parents=True, exist_ok=True)
+			shutil.move(dstfile, gamefile)
+		self.verify_index.record(file_info.filename, md5, self._build_tag())
+		if progress_handler:
+			progress_handler.file_download_complete(filename.name, file_info.size)
 		return True
 
 
+	def download_game_files(self, files, progress_handler = None, cancel_event = None, damaged: bool = False,
+			replace = ()):
+		"""
+		Downloads all chunks of `files` through one shared chunk queue
+		files: iterable of FileInfo. Earlier files are started first.
+		damaged: the existing game files are corrupt (repair). See `ChunkScheduler.add_file`.
+		replace: names of outdated game files. See `ChunkScheduler.add_file`.
+		"""
+		files = list(files)
+
+		def fetched(v) -> bool:
+			# Same as the size check of `_check_file_download_needed`
+			return damaged or v.filename in replace or try_get_file_size(gamedir(v.filename)) != v.size
+
+		saved, duplicates = self.chunk_store.plan(files, fetched)
+		if saved > 0:
+			infolog(f"Deduplication saves {bytes_to_MiB(saved)} MiB ({len(duplicates)} duplicate files)")
+		if progress_handler:
+			progress_handler.dedup_summary(saved, len(duplicates))
+
+		scheduler = self.start_chunk_download(progress_handler, cancel_event)
+		try:
+			for v in files:
+				scheduler.add_file(v, damaged, v.filename in replace)
+		finally:
+			self.finish_chunk_download(scheduler)
+
+
+	def start_chunk_download(self, progress_handler = None, cancel_event = None) -> ChunkScheduler:
+		"""
+		Starts a `ChunkScheduler` with adaptive concurrency. Queue the files with
+		`add_file` (after `chunk_store.plan`), then call `finish_chunk_download`.
+		"""
+		def on_concurrency_change(limit: int, throughput: float):
+			debuglog(f"Chunk requests in flight: {limit} ({bytes_to_MiB(throughput)} MiB/s)")
+			if progress_handler:
+				progress_handler.download_concurrency_changed(limit, throughput)
+
+		concurrency = AdaptiveConcurrency(OPT.min_download_concurrency, OPT.max_download_concurrency,
+			WORKER_CNT, on_concurrency_change)
+		load = LoadGovernor(OPT.min_download_concurrency, concurrency.maximum, WORKER_CNT) if OPT.background else None
+		scheduler = ChunkScheduler(self, concurrency.maximum, progress_handler, cancel_event, concurrency, load)
+		self.download_monitor = concurrency
+		scheduler.start()
+		return scheduler
+
+
+	def finish_chunk_download(self, scheduler: ChunkScheduler):
+		"""
+		Waits for all files queued in `scheduler`. Raises an exception if any file failed.
+		"""
+		try:
+			scheduler.finish()
+		finally:
+			self.download_monitor = None
+			self.verify_index.flush()
+		infolog(f"Reused {bytes_to_MiB(self.chunk_store.bytes_saved)} MiB of already downloaded data")
+
+
+	def take_snapshot(self) -> DirectorySnapshot:
+		"""
+		Lists the game directory, without our own temporary files
+		"""
+		exclude = { "ldiff" }
+		try:
+			exclude.add(OPT.tempdir.resolve().relative_to(OPT.gamedir.resolve()).as_posix())
+		except ValueError:
+			pass # not within the game directory
+		return DirectorySnapshot(OPT.gamedir, exclude)
+
+	def report_unknown_files(self, snapshot: DirectorySnapshot, progress_handler = None, files = None):
+		"""
+		Reports the files on disk that are not part of the loaded manifest
+		files: (optional) list of FileInfo or PkgVersionEntry to use instead of the manifest
+		"""
+		if files is None:
+			files = self.di_chunks.manifest.files
+		known = { v.filename for v in files }
+		known.add("config.ini") # see `check_config_ini`
+		# File lists of the game and of the voiceover packs
+		known.update(name for name in snapshot.entries if name.endswith("pkg_version") and "/" not in name)
+		unknown = snapshot.unknown_files(known)
+		if unknown:
+			infolog(f"{len(unknown)} file(s) in the game directory are not part of the manifest")
+			for filename in unknown:
+				debuglog(f"\t Unknown file: {filename}")
+		if progress_handler:
+			progress_handler.unknown_files(unknown)
+
+	def _report_sample_confidence(self, stats: dict, progress_handler = None):
+		"""
+		Summarizes a "balanced" repair. Files that were already verified count as checked.
+		"""
+		coverage = stats["checked_bytes"] / stats["total_bytes"] if stats["total_bytes"] else 1.0
+		upper = damage_rate_upper_bound(stats["chunks_damaged"], stats["chunks_checked"])
+		infolog(f"Sampled {coverage:.1%} of the game data, {stats['chunks_checked']} chunks. "
+			+ f"Damaged chunks: {stats['chunks_damaged']} (at most {upper:.2%} of all chunks with 95 % confidence)")
+		if progress_handler:
+			progress_handler.repair_confidence(
+				coverage = coverage,
+				chunks_checked = stats["chunks_checked"],
+				chunks_damaged = stats["chunks_damaged"],
+				damage_rate_upper_bound = upper
+			)
+
 	def update_config_ini_version(self):
 		"""
 		Quick file sanity check + file update after install or update
@@ -1040,6 +3096,7 @@ class SophonClient:
 			return
 
 		infolog("Checking game file integrity (quick) ...")
+		snapshot = self.take_snapshot()
 		# Do not abort in dry run
 		error_fn = warnlog if OPT.dry_run else abortlog
 		if OPT.do_install:
@@ -1047,7 +3104,7 @@ class SophonClient:
 				if v.flags == 64: # directory
 					continue
 
-				if try_get_file_size(gamedir(v.filename)) != v.size:
+				if snapshot.size(v.filename) != v.size:
 					error_fn(f"File missing or invalid size: {v.filename}")
 
 		# Similar check after updating
@@ -1055,7 +3112,7 @@ class SophonClient:
 			self.ldiff_manifest_required()
 
 			for v in self.di_diffs.manifest.files:
-				if try_get_file_size(gamedir(v.filename)) != v.size:
+				if snapshot.size(v.filename) != v.size:
 					error_fn(f"File missing or invalid size: {v.filename}")
 
 			# Check whether all old files are gone
@@ -1068,9 +3125,12 @@ class SophonClient:
 					deletelist = v.info.list
 
 			for v in deletelist:
-				if gamedir(v.filename).is_file():
+				if snapshot.is_file(v.filename):
 					error_fn(f"Old file still exists: {v.filename}")
 
+		if self.di_chunks.manifest is not None:
+			self.report_unknown_files(snapshot)
+
 		self.installed_ver = self.di_chunks.getBuild_json["data"]["tag"] # "MAJOR.MINOR.PATCH"
 		contents = contents.replace(ver[0], self.installed_ver)
 		if OPT.dry_run:
@@ -1096,11 +3156,61 @@ class SophonClient:
 		return pinfo
 
 
-	def _download_ldiff_file(self, ldiff_dir: pathlib.Path, v: manifest_ldiff_pb2.DiffFileInfo, progress_handler = None):
+	def plan_update(self) -> UpdatePlan:
+		"""
+		Decides for each modified file whether applying its patch or downloading its
+		chunks is cheaper. Based on the manifests and the chunk store only (no requests).
+		Requires self.load_manifest(CATEGORY)
 		"""
-		Helper function to download one diff file.
+		self.ldiff_manifest_required()
 
-		Returns the patch file name on success, else None.
+		download_rate = PLAN_DOWNLOAD_RATE
+		for limiter in self._download_limiters():
+			if limiter.rate > 0:
+				download_rate = min(download_rate, limiter.rate)
+
+		chunk_files = {v.filename: v for v in self.di_chunks.manifest.files}
+		cached = self.chunk_store.cached_ids()
+		patches = [(v, self.get_ldiff_patchinfo(v)) for v in self.di_diffs.manifest.files]
+		users = collections.Counter(pinfo.patch_id for _, pinfo in patches if pinfo is not None)
+
+		plan = UpdatePlan(download_rate)
+		for v, pinfo in patches:
+			if pinfo is None:
+				continue # not modified
+
+			if OPT.ldiff_ranges:
+				patch_bytes = pinfo.patch_length
+			else:
+				# The entire diff file is downloaded once for all its users
+				patch_bytes = pinfo.patch_size // users[pinfo.patch_id]
+			patch_seconds = (pinfo.original_size + v.size) / PLAN_PATCH_RATE
+			if max(pinfo.original_size, v.size) > PATCH_IN_PROCESS_MAX_SIZE:
+				patch_seconds += PLAN_PATCH_PROCESS_TIME
+
+			file_info = chunk_files.get(v.filename)
+			chunk_bytes = -1
+			if file_info is not None:
+				# Upper bound: unchanged chunks of the installed file are reused, but which
+				# ones is only known after reading it. Counting them here would mean hashing
+				# every modified file twice, and the plan must not prefer chunks because of
+				# a reuse that may not happen.
+				chunk_bytes = sum(c.compressed_size for c in file_info.chunks if c.chunk_id not in cached)
+			# Written once, plus checking the chunks of the copied installed file
+			chunk_seconds = (v.size + min(pinfo.original_size, v.size)) / PLAN_CHUNK_RATE
+			plan.add(UpdatePlanEntry(v.filename, patch_bytes, patch_seconds, chunk_bytes, chunk_seconds))
+
+		if EXPORT_JSON_FILES:
+			with tempdir("update-plan.json").open("w") as fh:
+				json.dump(plan.to_json(), fh)
+		return plan
+
+
+	def _check_ldiff_file(self, v: manifest_ldiff_pb2.DiffFileInfo, progress_handler = None) -> manifest_ldiff_pb2.PatchInfo:
+		"""
+		Helper function to check whether one file needs its diff file.
+
+		Returns the patch info if the file is ready for patching, else None.
 		"""
 		if progress_handler:
 			progress_handler.ldiff_download_start(v.filename)
@@ -1142,7 +3252,7 @@ class SophonClient:
 
 			if gamefilesize == v.size:
 				# Maybe already up-to-date?
-				md5 = hashlib.md5(gamefile.read_bytes()).hexdigest()
+				md5 = md5_file(gamefile)
 				if md5 == v.hash:
 					if progress_handler:
 						progress_handler.ldiff_download_skipped(v.filename, "already updated")
@@ -1155,20 +3265,47 @@ class SophonClient:
 				if progress_handler:
 					progress_handler.ldiff_download_skipped(v.filename, "file missing")
 				infolog(f"Cannot find file '{gamefile.name}'. Adding to chunk download queue.")
-				self.new_files_to_download.add(v.filename)
+				self._download_by_chunks_instead(v.filename)
 				return None
 
-			md5 = md5 if md5 else hashlib.md5(gamefile.read_bytes()).hexdigest()
+			md5 = md5 if md5 else md5_file(gamefile)
 			if progress_handler:
 				progress_handler.ldiff_download_skipped(v.filename, "file corrupt")
 			warnlog(f"md5 hash mismatch in '{gamefile.name}'. is={md5}, should={pinfo.original_hash} or {v.hash}")
-			self.new_files_to_download.add(v.filename)
-			# TODO. shall the file be removed?
+			self._download_by_chunks_instead(v.filename, outdated=True)
 			return None
 
+		return pinfo
+
+
+	def _download_by_chunks_instead(self, filename: str, outdated: bool = False):
+		"""
+		Queues a file of the ldiff update for the chunk download.
+		outdated: the game file exists. It must be replaced even if its size is correct.
+		"""
+		with self.ldiff_lock:
+			self.new_files_to_download.add(filename)
+			if outdated:
+				self.outdated_files.add(filename)
+
+
+	def _download_ldiff_blob(self, ldiff_dir: pathlib.Path, v: manifest_ldiff_pb2.DiffFileInfo,
+			pinfo: manifest_ldiff_pb2.PatchInfo, sections = None, progress_handler = None):
+		"""
+		Helper function to download one diff file unless present.
+		`v` is one of the files the diff file (patch blob) is needed for.
+		sections: (optional) (offset, length) of the patches that will be applied
+
+		Returns the patch file name on success, else None.
+		"""
 		ldiffname = ldiff_dir.joinpath(pinfo.patch_id)
+		partial = LdiffSections(ldiffname)
+		ranges = self._ldiff_download_ranges(pinfo, sections)
 
-		if try_get_file_size(ldiffname) == pinfo.patch_size:
+		present = (try_get_file_size(ldiffname) == pinfo.patch_size)
+		if present and partial.exists():
+			present = ranges is not None and all(partial.covers(*r) for r in ranges)
+		if present:
 			# Already downloaded. Skip.
 			# TODO: do a proper hash check
 			if progress_handler:
@@ -1188,6 +3325,24 @@ class SophonClient:
 			return None
 
 		DIFF_URL_PREFIX = self.di_diffs.category_json["diff_download"]["url_prefix"]
+		if ranges is not None:
+			if self._download_ldiff_sections(DIFF_URL_PREFIX + "/" + pinfo.patch_id, ldiffname, pinfo, partial, ranges):
+				if progress_handler:
+					progress_handler.ldiff_download_complete(v.filename, sum(length for _, length in ranges))
+				return ldiffname.name
+			warnlog(f"Range requests are not supported for '{ldiffname.name}'. Downloading the entire file.")
+			# The sections are not needed anymore. Their reservation is replaced by the one below.
+			ldiffname.unlink(missing_ok=True)
+			partial.remove()
+			with self.ldiff_lock:
+				size = self.ldiff_space_reserved.pop(ldiffname.name, 0)
+			temp_space.release(size, persistent=True)
+
+		# Kept until `_remove_ldiff_blob` or `remove_ldiff_files`
+		temp_space.reserve(pinfo.patch_size, ldiff_dir, persistent=True)
+		with self.ldiff_lock:
+			self.ldiff_space_reserved[ldiffname.name] = self.ldiff_space_reserved.get(ldiffname.name, 0) + pinfo.patch_size
+
 		self._download_file_resume(DIFF_URL_PREFIX + "/" + pinfo.patch_id, tmp_file, pinfo.patch_size)
 		debuglog("Download done")
 
@@ -1197,11 +3352,96 @@ class SophonClient:
 		# Move to original ldiff file name (without _tmp)
 		# This does not need special dry-run handling (game files are not affected)
 		shutil.move(tmp_file, ldiffname)
+		partial.remove() # complete now
 		if progress_handler:
 			progress_handler.ldiff_download_complete(v.filename, pinfo.patch_size)
 		return ldiffname.name
 
 
+	def _ldiff_download_ranges(self, pinfo: manifest_ldiff_pb2.PatchInfo, sections) -> list[tuple[int, int]] | None:
+		"""
+		Helper function. Coalesces the needed `sections` of a diff file into download ranges.
+
+		Returns `None` if the entire diff file should be downloaded.
+		"""
+		if not OPT.ldiff_ranges or not sections:
+			return None
+		ranges = coalesce_ranges(sections, LDIFF_RANGE_GAP)
+		if sum(length for _, length in ranges) > pinfo.patch_size * LDIFF_RANGE_MAX_SHARE:
+			return None
+		return ranges
+
+
+	def _download_ldiff_sections(self, url: str, ldiffname: pathlib.Path, pinfo: manifest_ldiff_pb2.PatchInfo,
+			partial: LdiffSections, ranges: list[tuple[int, int]]) -> bool:
+		"""
+		Helper function of `_download_ldiff_blob`. Downloads the missing `ranges` into
+		a sparse file of the full diff file size. hpatchz reads the sections from there.
+
+		Returns `False` if the server does not support range requests.
+		"""
+		missing = [r for r in ranges if not partial.covers(*r)]
+		size = sum(length for _, length in missing)
+		infolog(f"Downloading {len(missing)} section(s) of diff '{ldiffname.name}', "
+		        f"{bytes_to_MiB(size)} of {bytes_to_MiB(pinfo.patch_size)} MiB")
+
+		# Kept until `_remove_ldiff_blob` or `remove_ldiff_files`
+		temp_space.reserve(size, ldiffname.parent, persistent=True)
+		with self.ldiff_lock:
+			self.ldiff_space_reserved[ldiffname.name] = self.ldiff_space_reserved.get(ldiffname.name, 0) + size
+
+		if not partial.exists():
+			# Mark the file as partial before it gets its full size
+			ldiffname.unlink(missing_ok=True)
+			partial.add(0, 0)
+		fd = os.open(ldiffname, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			os.ftruncate(fd, pinfo.patch_size)
+			for offset, length in missing:
+				if not self._download_range(url, fd, offset, length, ldiffname.name):
+					return False
+				partial.add(offset, length)
+		finally:
+			os.close(fd)
+		debuglog("Download done")
+		return True
+
+
+	def _download_range(self, url: str, fd: int, offset: int, length: int, name: str) -> bool:
+		"""
+		Downloads `length` bytes of `url` from `offset` on into `fd` at the same offset
+
+		Returns `False` if the server ignored the range request.
+		"""
+		engine = get_download_engine()
+		done = 0
+		errCnt = 0
+		errLogs = []
+		while True: # run up to 5 times
+			writer = PositionalWriter(fd, offset + done)
+
+			def on_data(data):
+				if done + writer.bytes_written + len(data) > length:
+					return 0 # more data than requested: abort
+				writer.write(data)
+
+			req = engine.fetch(url, on_data, f"{offset + done}-{offset + length - 1}",
+				self.download_monitor, self._download_limiters())
+			if req.response_code == 200:
+				return False
+			done += writer.bytes_written
+			if not req.error and done == length:
+				return True
+
+			errno, errstr = req.error or (0, f"Incomplete range ({done} of {length} bytes)")
+			errCnt += 1
+			errLogs.append(f"Error {errno}: {errstr}")
+			if errCnt >= 5:
+				abortlog(f"Cannot download diff '{name}': " + ", ".join(errLogs))
+			warnlog(f"Error {errno}: {errstr}. Retrying ({errCnt}/5)...")
+			time.sleep(10)
+
+
 	def _apply_ldiff_file(self, ldiff_dir: pathlib.Path, v: manifest_ldiff_pb2.DiffFileInfo, progress_handler = None):
 		"""
 		Helper function to apply one diff file.
@@ -1223,35 +3463,55 @@ class SophonClient:
 		gamefile = gamedir(v.filename)
 
 		# Patched file goes into the temporary directory (at first)
-		dstfile = tempdir(pathlib.Path(v.filename).name)
+		# The full path keeps the names unique among the files patched in parallel
+		dstfile = download_temp_path(v.filename + ".patched")
 		dstfile.unlink(True)  # remove any existing duplicate temporary file
 
 		ldiffname = ldiff_dir.joinpath(pinfo.patch_id)
+		partial = LdiffSections(ldiffname)
 
-		if not ldiffname.is_file():
+		if not ldiffname.is_file() or (partial.exists() and not partial.covers(pinfo.patch_offset, pinfo.patch_length)):
 			if OPT.disallow_download:
 				return
 			if progress_handler:
 				progress_handler.ldiff_patch_error(v.filename, "diff file missing")
 			abortlog(f"Diff file {ldiffname.name} is missing. Please redownload.")
 
+		temp_space.reserve(v.size, OPT.tempdir)
+		try:
+			self._patch_to_file(v, pinfo, gamefile, dstfile, ldiffname, progress_handler)
+		finally:
+			temp_space.release(v.size)
+
+
+	def _patch_to_file(self, v: manifest_ldiff_pb2.DiffFileInfo, pinfo: manifest_ldiff_pb2.PatchInfo,
+			gamefile: pathlib.Path, dstfile: pathlib.Path, ldiffname: pathlib.Path, progress_handler = None):
+		"""
+		Helper function of `_apply_ldiff_file`. Patches `gamefile` into `dstfile` and moves it back.
+		"""
 		# Apply the patch file
-		done = hpatchz_patch_file(gamefile, dstfile, ldiffname, pinfo.patch_offset, pinfo.patch_length)
-		if not done:
-			# retry with longer timeout
-			done = hpatchz_patch_file(gamefile, dstfile, ldiffname, pinfo.patch_offset, pinfo.patch_length, 300)
+		md5 = None
+		if max(pinfo.original_size, v.size) <= PATCH_IN_PROCESS_MAX_SIZE:
+			md5 = hdiffpatch_patch_file(gamefile, dstfile, ldiffname, pinfo.patch_offset, pinfo.patch_length, v.size)
+		if md5 is None:
+			done = hpatchz_patch_file(gamefile, dstfile, ldiffname, pinfo.patch_offset, pinfo.patch_length)
+			if not done:
+				# retry with longer timeout
+				done = hpatchz_patch_file(gamefile, dstfile, ldiffname, pinfo.patch_offset, pinfo.patch_length, 300)
 
 		# Verify patched file integrity (NOTE: hpatchz might already have checked it)
 		assert dstfile.stat().st_size == v.size
-		md5 = hashlib.md5(dstfile.read_bytes()).hexdigest()
+		if md5 is None:
+			md5 = md5_file(dstfile)
 		if md5 != v.hash:
 			if progress_handler:
 				progress_handler.ldiff_patch_error(v.filename, "checksum failed")
 			warnlog(f"Checksum failed on file {v.filename}. Corrupt?")
-			# Retry by downloading from scratch
-			self.new_files_to_download.add(v.filename)
-		else:
-			infolog(f"Patched file {v.filename}")
+			# Retry by downloading from scratch. The game file is left as it is.
+			self._download_by_chunks_instead(v.filename, outdated=True)
+			dstfile.unlink(missing_ok=True)
+			return
+		infolog(f"Patched file {v.filename}")
 
 		# Replace the game install file
 		if OPT.dry_run:
@@ -1259,6 +3519,7 @@ class SophonClient:
 			return
 
 		shutil.move(dstfile, gamefile)
+		self.verify_index.record(v.filename, md5, self._build_tag())
 
 
 	def apply_or_prepare_ldiff_files(self, progress_handler = None):
@@ -1273,12 +3534,23 @@ class SophonClient:
 		ldiff_dir = gamedir("ldiff")
 		ldiff_dir.mkdir(exist_ok=True)
 
+		plan = self.plan_update()
+		infolog(f"Update plan: {plan.count('ldiff')} files by ldiff, {plan.count('chunks')} by chunks, "
+		        f"{bytes_to_MiB(plan.download_bytes())} MiB, about {plan.estimated_seconds():.0f} s")
+		if progress_handler:
+			progress_handler.update_plan(
+				ldiff_files=plan.count("ldiff"),
+				chunk_files=plan.count("chunks"),
+				download_size=plan.download_bytes(),
+				estimated_seconds=plan.estimated_seconds(),
+			)
+
 		# Sum up the entire download size
 		download_sizes_checked = set() # values: patchname
 		download_size_total = 0
 		for v in self.di_diffs.manifest.files:
 			pinfo = self.get_ldiff_patchinfo(v)
-			if not pinfo:
+			if not pinfo or plan.method(v.filename) == "chunks":
 				continue
 			if pinfo.patch_id in download_sizes_checked:
 				continue
@@ -1300,42 +3572,158 @@ class SophonClient:
 
 		what_txt = " and patched" if OPT.predownload else ""
 
-		checked = set()
-		# Loop through the file list and download what's missing
+		# Files sharing a diff file (patch_id) are handled as one group: the diff file
+		# is downloaded once, applied to all of them and removed after the last one.
+		groups: dict[str, list] = {}
 		for v in self.di_diffs.manifest.files:
-			# TODO: Download one file an apply the patches to all files that make use of it
-			# Motivation: less space consumption by temporary files
-
-			downloaded = self._download_ldiff_file(ldiff_dir, v, progress_handler=progress_handler)
-			if RUN_MEMORY_HACK:
-				force_memory_release()
-			if downloaded:
-				self.ldiff_files_to_remove.add(downloaded)
+			pinfo = self.get_ldiff_patchinfo(v)
+			key = pinfo.patch_id if pinfo is not None else "file:" + v.filename
+			groups.setdefault(key, []).append(v)
+
+		# Pipeline: the download workers hand the files over to the patch workers.
+		# `slots` bounds the diff files in flight, thus the disk space they take.
+		slots = threading.Semaphore(LDIFF_PIPELINE_DEPTH)
+		failed = threading.Event()
+		patch_futures = []
+		consumers_left: dict[str, int] = {} # ldiff file name -> files still to patch
+		keep = set() # ldiff file names needed for a later attempt
+
+		def file_done(v: manifest_ldiff_pb2.DiffFileInfo):
+			nonlocal files_done
+			with self.ldiff_lock:
+				files_done += 1
+				relname = pathlib.Path(v.filename).name
+				infolog(f"Progress: {files_done} / {files_total} files | Done: {relname}", end="\r")
+				if files_done % 100 == 0:
+					print("")
+
+		def patch_job(v: manifest_ldiff_pb2.DiffFileInfo, ldiffname: str):
+			try:
+				if progress_handler:
+					progress_handler.ldiff_patch_start(v.filename)
+				self._apply_ldiff_file(ldiff_dir, v, progress_handler=progress_handler)
+				if progress_handler:
+					progress_handler.ldiff_patch_complete(v.filename)
+				if RUN_MEMORY_HACK:
+					force_memory_release()
+			except BaseException:
+				failed.set()
+				with self.ldiff_lock:
+					keep.add(ldiffname)
+				raise
+			finally:
+				file_done(v)
+				with self.ldiff_lock:
+					consumers_left[ldiffname] -= 1
+					last = (consumers_left[ldiffname] == 0)
+				if last:
+					if ldiffname not in keep:
+						self._remove_ldiff_blob(ldiff_dir, ldiffname)
+					slots.release()
+
+		def download_job(group: list):
+			consumers = []
+			handed_over = False
+			try:
+				pinfo = None
+				sections = [] # of the diff file, needed for our installed files
+				for v in group:
+					file_pinfo = self._check_ldiff_file(v, progress_handler=progress_handler)
+					if file_pinfo is None:
+						file_done(v)
+						continue
+					if plan.method(v.filename) == "chunks":
+						if progress_handler:
+							progress_handler.ldiff_download_skipped(v.filename, "chunks cheaper")
+						debuglog(f"Downloading '{v.filename}' by chunks instead (cheaper).")
+						self._download_by_chunks_instead(v.filename, outdated=True)
+						file_done(v)
+						continue
+					consumers.append(v)
+					pinfo = file_pinfo
+					sections.append((pinfo.patch_offset, pinfo.patch_length))
+
+				downloaded = None
+				if consumers:
+					downloaded = self._download_ldiff_blob(ldiff_dir, consumers[0], pinfo, sections,
+						progress_handler=progress_handler)
+				if RUN_MEMORY_HACK:
+					force_memory_release()
+				if not downloaded:
+					return
+
+				with self.ldiff_lock:
+					self.ldiff_files_to_remove.add(downloaded)
 				if not OPT.predownload:
-					# Normal case: update the file
-					if progress_handler:
-						progress_handler.ldiff_patch_start(v.filename)
-					self._apply_ldiff_file(ldiff_dir, v, progress_handler=progress_handler)
-					if progress_handler:
-						progress_handler.ldiff_patch_complete(v.filename)
-					if RUN_MEMORY_HACK:
-						force_memory_release()
-				elif OPT.TESTING_FILE and (OPT.TESTING_FILE in v.filename):
-					# Allow patching individual files beforehand
-					warnlog(f"ENTER TO APPLY PATCH (will create backup file): ", OPT.TESTING_FILE)
-					input()
-					gamefile = gamedir(v.filename)
-					shutil.copy2(gamefile, f"{gamefile}.bak")
-					self._apply_ldiff_file(ldiff_dir, v)
-
-			files_done += 1
-			relname = pathlib.Path(v.filename).name
-			infolog(f"Progress: {files_done} / {files_total} files | Downloaded: {relname}", end="\r")
-			if files_done % 100 == 0:
-				print("")
+					# Normal case: update the files
+					consumers_left[downloaded] = len(consumers)
+					for v in consumers:
+						patch_futures.append(patch_pool.submit(patch_job, v, downloaded))
+					consumers = []
+					handed_over = True
+				elif OPT.TESTING_FILE:
+					for v in consumers:
+						if not (OPT.TESTING_FILE in v.filename):
+							continue
+						# Allow patching individual files beforehand
+						warnlog(f"ENTER TO APPLY PATCH (will create backup file): ", OPT.TESTING_FILE)
+						input()
+						gamefile = gamedir(v.filename)
+						shutil.copy2(gamefile, f"{gamefile}.bak")
+						self._apply_ldiff_file(ldiff_dir, v)
+			except BaseException:
+				failed.set()
+				raise
+			finally:
+				for v in consumers:
+					file_done(v)
+				if not handed_over:
+					slots.release()
+
+		# One at a time for interactive testing
+		download_workers = 1 if OPT.TESTING_FILE else LDIFF_DOWNLOAD_WORKER_CNT
+		initializer = enter_background_priority if OPT.background else None
+		with concurrent.futures.ThreadPoolExecutor(max_workers=LDIFF_PATCH_WORKER_CNT,
+				initializer=initializer) as patch_pool:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers,
+					initializer=initializer) as download_pool:
+				download_futures = []
+				# Loop through the file list and download what's missing
+				for group in groups.values():
+					slots.acquire()
+					if failed.is_set():
+						break
+					download_futures.append(download_pool.submit(download_job, group))
+				for future in download_futures:
+					future.result()
+			# All patch jobs are submitted once the downloads are done
+			for future in patch_futures:
+				future.result()
 		infolog("\nFiles downloaded" + what_txt + ".") # keep the last "100 %" line
+		self.verify_index.flush()
+		if OPT.predownload:
+			# The files stay for the actual update. Not our business anymore.
+			temp_space.release(sum(self.ldiff_space_reserved.values()), persistent=True)
+			self.ldiff_space_reserved = {}
 
-	# Note: the downloaded ldiff files are removed by `self.remove_ldiff_files`
+	# Note: ldiff files that were not applied are removed by `self.remove_ldiff_files`
+
+
+	def _remove_ldiff_blob(self, ldiff_dir: pathlib.Path, ldiffname: str):
+		"""
+		Helper function to remove a diff file after the last file that uses it was patched.
+		"""
+		if OPT.dry_run:
+			infolog(f"[remove now unused ldiff '{ldiffname}']")
+			return
+
+		ldiff_dir.joinpath(ldiffname).unlink(missing_ok=True)
+		LdiffSections(ldiff_dir.joinpath(ldiffname)).remove()
+		with self.ldiff_lock:
+			self.ldiff_files_to_remove.discard(ldiffname)
+			size = self.ldiff_space_reserved.pop(ldiffname, 0)
+		temp_space.release(size, persistent=True)
+		debuglog(f"Removed applied ldiff '{ldiffname}'")
 
 
 	def process_deletefiles(self, progress_handler = None):
@@ -1383,6 +3771,7 @@ class SophonClient:
 		if OPT.predownload:
 			infolog("New files download is DISABLED for predownloads!")
 			self.new_files_to_download.clear()
+			self.outdated_files.clear()
 			return
 
 		download_size_total = self.get_chunk_download_size(True)
@@ -1397,34 +3786,13 @@ class SophonClient:
 			)
 		del download_size_total
 
-		# Not accurate when there are too many new files (chunks)
-		files_total = len(self.new_files_to_download)
-		files_done = 0
-
-		def download_file(v):
-			err_cnt = 0
-			err_logs = []
-			while err_cnt < 5:
-				try:
-					if cancel_event and cancel_event.is_set():
-						progress_handler.job_error("cancelled")
-						raise Exception("Installation cancelled")
-					self.download_game_file(v, install_progress_handler=progress_handler, cancel_event=cancel_event)
-					break
-				except Exception as e:
-					err_cnt += 1
-					err_logs.append(str(e))
-			if err_cnt == 5:
-				raise Exception(f"Download file {v.name} failed after 3 attempts: {err_logs}")["pkg_version", ""]
-
-		with concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_CNT) as executor:
-			repair_files = [v for v in self.di_chunks.manifest.files if v.filename in self.new_files_to_download]
-			futures = [executor.submit(download_file, v) for v in repair_files]
-			for future in concurrent.futures.as_completed(futures):
-				future.result()
+		repair_files = [v for v in self.di_chunks.manifest.files if v.filename in self.new_files_to_download]
+		self.download_game_files(repair_files, progress_handler=progress_handler, cancel_event=cancel_event,
+			damaged=isinstance(OPT.repair_mode, str), replace=self.outdated_files)
 
 		infolog("Download complete.")
 		self.new_files_to_download.clear()
+		self.outdated_files.clear()
 
 
 	def remove_ldiff_files(self, progress_handler = None):
@@ -1460,9 +3828,12 @@ class SophonClient:
 				continue
 
 			filename.unlink() # delete
+			LdiffSections(filename).remove()
 			if progress_handler:
 				progress_handler.delete_file(filename.name, ldiff=True)
 		infolog(f"Cleaned up {count} now unused ldiff files.")
+		temp_space.release(sum(self.ldiff_space_reserved.values()), persistent=True)
+		self.ldiff_space_reserved = {}
 
 
 	def repair_by_category(self, cat_name: str, repair_progress_handler = None, cancel_event = None):
@@ -1472,49 +3843,50 @@ class SophonClient:
 		"""
 		assert not OPT.predownload, "Not allowed for pre-downloads."
 
-		# Here we can either use the manifest or pkg_version
-
-		self.load_manifest(cat_name)
-
-		if self.installed_ver != self.di_chunks.getBuild_json["data"]["tag"]:
-			abortlog(f"The installed version is outdated. {self.installed_ver} / {self.di_chunks.getBuild_json['data']['tag']} Run an update first.")
-
 		self.new_files_to_download.clear()
 
 		reliable_checking = (OPT.repair_mode == "reliable")
-		infolog(f"Repair started. Mode: {reliable_checking}")
+		sampled_checking = (OPT.repair_mode == "balanced")
+		infolog(f"Repair started. Mode: {OPT.repair_mode}")
+
+		# Verify against the pkg_version file of the install if possible (offline).
+		# The manifest is then only fetched once a file needs to be repaired.
+		# Sampling needs the chunk checksums of the manifest.
+		files = None
+		manifest_files: dict[str, manifest_pb2.FileInfo] | None = None
+		if OPT.repair_use_pkg_version and not sampled_checking:
+			files = self.load_pkg_version(cat_name)
+		if files is None:
+			self._load_repair_manifest(cat_name)
+			files = self.di_chunks.manifest.files
+			manifest_files = { v.filename: v for v in files }
+		else:
+			infolog(f"Verifying {len(files)} files listed in the local pkg_version")
+		manifest_lock = threading.Lock()
+		manifest_error: str | None = None
+		unrepairable: list[str] = []
 
 		files_checked = 0
-		files_total = len(self.di_chunks.manifest.files)
+		files_total = len(files)
 
 		if repair_progress_handler:
 			repair_progress_handler.repair_summary(
 				repair_mode=OPT.repair_mode,
 				total_files=files_total
 			)
-		import threading
 		lock = threading.Lock()
-		def _verify_file(v):
+		ranges_left: dict[str, int] = {} # filename -> chunk ranges not verified yet
+		damaged: dict[str, str] = {}     # filename -> reason, for files verified in ranges
+		rng = random.Random()
+		sample_stats = { "total_bytes": 0, "checked_bytes": 0, "chunks_checked": 0, "chunks_damaged": 0 }
+
+		def _check_cancel():
 			if cancel_event and cancel_event.is_set():
 				if repair_progress_handler:
 					repair_progress_handler.job_error("cancelled")
 				raise Exception("Repair cancelled")
 
-			reason = None
-			gamefile = gamedir(v.filename)
-			gamefilesize = try_get_file_size(gamefile)
-			if gamefilesize != v.size:
-				reason = f"size mismatch. is={gamefilesize}, should={v.size}"
-			elif reliable_checking:
-				md5 = hashlib.md5(gamefile.read_bytes()).hexdigest()
-				if md5 != v.md5:
-					reason = f"md5 mismatch. is={md5}, should={v.md5}"
-				del md5
-			del gamefilesize, gamefile
-
-			if RUN_MEMORY_HACK:
-				force_memory_release()
-
+		def _report(v, reason):
 			if repair_progress_handler:
 				repair_progress_handler.check_file(
 					filename=v.filename,
@@ -1529,13 +3901,196 @@ class SophonClient:
 			infolog(f"Need to repair file '{v.filename}': " + reason)
 			with lock:
 				self.new_files_to_download.add(v.filename)
+			_queue_repair(v)
+
+		def _queue_repair(v):
+			"""
+			Downloads the file while the scan goes on. Fetches the manifest on first use.
+			"""
+			nonlocal manifest_files, manifest_error
+			with manifest_lock:
+				if manifest_files is None and manifest_error is None:
+					try:
+						self._load_repair_manifest(cat_name)
+						manifest_files = { f.filename: f for f in self.di_chunks.manifest.files }
+					except Exception as e:
+						manifest_error = str(e)
+						warnlog(f"Cannot fetch the manifest for repairs: {e}")
+				if manifest_error is not None:
+					return
+			file_info = manifest_files.get(v.filename)
+			if file_info is None:
+				warnlog(f"File '{v.filename}' is not part of the manifest")
+				with lock:
+					unrepairable.append(v.filename)
+				return
+			self.chunk_store.plan([file_info])
+			scheduler.add_file(file_info, damaged=True)
 
-		with concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_CNT_VERIFY) as executor:
-			futures = [
-				executor.submit(_verify_file, v) for v in self.di_chunks.manifest.files
-			]
-			for future in concurrent.futures.as_completed(futures):
-				future.result()
+		def _verify_file(v):
+			_check_cancel()
+			md5 = md5_file(gamedir(v.filename))
+			if md5 == v.md5:
+				self.verify_index.record(v.filename, md5, self.installed_ver)
+				_report(v, None)
+			else:
+				_report(v, f"md5 mismatch. is={md5}, should={v.md5}")
 
-		print("") # Keep the last "100 %" line
-		self.diff_download_new_files(progress_handler=repair_progress_handler, cancel_event=cancel_event)
+		def _verify_range(v, chunks, complete: bool = True):
+			"""
+			complete: `chunks` cover the entire file. `False` for samples.
+			"""
+			_check_cancel()
+			reason = None
+			checked = []
+			if v.filename not in damaged: # otherwise already known to be bad
+				fd = os.open(gamedir(v.filename), os.O_RDONLY)
+				try:
+					for c in chunks:
+						checked.append(c)
+						if not chunk_intact(fd, c):
+							reason = f"chunk md5 mismatch at offset {c.offset}"
+							break
+				finally:
+					os.close(fd)
+
+			with lock:
+				sample_stats["chunks_checked"] += len(checked)
+				sample_stats["checked_bytes"] += sum(c.uncompressed_size for c in checked)
+				if reason:
+					sample_stats["chunks_damaged"] += 1
+					damaged.setdefault(v.filename, reason)
+				ranges_left[v.filename] -= 1
+				if ranges_left[v.filename] > 0:
+					return
+				reason = damaged.pop(v.filename, None)
+			if reason is None and complete:
+				# All chunk ranges match, hence so does the whole file
+				self.verify_index.record(v.filename, v.md5, self.installed_ver)
+			_report(v, reason)
+
+		# Damaged files are downloaded while the scan goes on
+		scheduler = self.start_chunk_download(repair_progress_handler, cancel_event)
+		try:
+			# Check the metadata and plan the hashing work
+			snapshot = self.take_snapshot()
+			self.report_unknown_files(snapshot, repair_progress_handler, files)
+			jobs = [] # (bytes, function, args...)
+			for v in files:
+				_check_cancel()
+				st = snapshot.stat(v.filename)
+				gamefilesize = -1 if st is None else st.st_size
+				if gamefilesize != v.size:
+					_report(v, f"size mismatch. is={gamefilesize}, should={v.size}")
+					continue
+				if not (reliable_checking or sampled_checking):
+					_report(v, None)
+					continue
+
+				sample_stats["total_bytes"] += v.size
+				md5 = self.verify_index.lookup(v.filename, st)
+				if md5 is not None:
+					sample_stats["checked_bytes"] += v.size
+					_report(v, None if md5 == v.md5 else f"md5 mismatch. is={md5}, should={v.md5}")
+					continue
+
+				if sampled_checking:
+					chunks = sample_chunks(v, OPT.repair_sample_percent, rng)
+					ranges_left[v.filename] = 1
+					jobs.append((sum(c.uncompressed_size for c in chunks), _verify_range, v, chunks, False))
+					continue
+
+				ranges = split_chunk_ranges(v, VERIFY_RANGE_SIZE) if v.size >= VERIFY_SPLIT_SIZE else None
+				if ranges is None:
+					jobs.append((v.size, _verify_file, v))
+					continue
+				ranges_left[v.filename] = len(ranges)
+				for chunks in ranges:
+					jobs.append((sum(c.uncompressed_size for c in chunks), _verify_range, v, chunks))
+
+			load = LoadGovernor(1, WORKER_CNT_VERIFY) if OPT.background else None
+			def _run_job(function, *args):
+				if load:
+					load.acquire()
+				try:
+					function(*args)
+				finally:
+					if load:
+						load.release()
+
+			# Largest first, so that no big file is left for the end
+			jobs.sort(key=lambda job: job[0], reverse=True)
+			with concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_CNT_VERIFY,
+					initializer=enter_background_priority if OPT.background else None) as executor:
+				futures = [
+					executor.submit(_run_job, *job[1:]) for job in jobs
+				]
+				for future in concurrent.futures.as_completed(futures):
+					future.result()
+			print("") # Keep the last "100 %" line
+
+			infolog(f"Scan complete. Files to repair: {len(self.new_files_to_download)}")
+			if sampled_checking:
+				self._report_sample_confidence(sample_stats, repair_progress_handler)
+			if repair_progress_handler:
+				repair_progress_handler.download_summary(
+					game_version = self.installed_ver,
+					download_size = self.get_chunk_download_size(True) if manifest_files is not None else 0,
+					download_file_count = len(self.new_files_to_download),
+					download_categories = [ "game" ]
+				)
+		finally:
+			self.finish_chunk_download(scheduler)
+
+		if manifest_error is not None:
+			abortlog(f"{len(self.new_files_to_download)} file(s) need to be repaired, "
+				+ f"but the manifest is not available: {manifest_error}")
+		if unrepairable:
+			abortlog(f"Cannot repair {len(unrepairable)} file(s) that are not part of the manifest: "
+				+ ", ".join(unrepairable))
+		infolog("Download complete.")
+		self.new_files_to_download.clear()
+
+
+	def _load_repair_manifest(self, cat_name: str):
+		"""
+		Fetches the manifest of the installed version for repairs
+		"""
+		self.retrieve_API_keys()
+		self.load_manifest(cat_name)
+
+		if self.installed_ver != self.di_chunks.getBuild_json["data"]["tag"]:
+			abortlog(f"The installed version is outdated. {self.installed_ver} / {self.di_chunks.getBuild_json['data']['tag']} Run an update first.")
+
+
+	def load_pkg_version(self, cat_name: str) -> list[PkgVersionEntry] | None:
+		"""
+		Reads the file list that comes with the install: `pkg_version` for "game",
+		`Audio_<language>_pkg_version` for voiceover packs.
+		Returns `None` if there is no such file.
+		"""
+		if cat_name == "game":
+			fname = "pkg_version"
+		else:
+			names = [k for k, v in VOICEOVERS_LUT.items() if v["short"] == cat_name]
+			if len(names) != 1:
+				return None
+			fname = f"Audio_{names[0]}_pkg_version"
+
+		try:
+			lines = gamedir(fname).read_text(encoding="utf-8").splitlines()
+		except FileNotFoundError:
+			return None
+
+		entries = []
+		for line in lines:
+			if not line.strip():
+				continue
+			try:
+				js = json.loads(line)
+				filename_safety_check(js["remoteName"])
+				entries.append(PkgVersionEntry(js["remoteName"], int(js["fileSize"]), js["md5"].lower()))
+			except (ValueError, KeyError, TypeError, AssertionError) as e:
+				warnlog(f"Ignoring {fname}: invalid line ({e})")
+				return None
+		return entries
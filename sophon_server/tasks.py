@@ -1,10 +1,10 @@
-import threading, os, pathlib, concurrent.futures, re, shutil
+import threading, os, pathlib, re, shutil
 from typing import Dict, Optional, Literal
 
 from progress_handlers import InstallProgressHandler, RepairProgressHandler, UpdateProgressHandler
 from models import InstallRequest, RepairRequest, UpdateRequest, TaskStatus, OnlineGameInfo
 from utils import ConnectionManager
-from sophon_api import Options, SophonClient, force_memory_release, RUN_MEMORY_HACK, WORKER_CNT
+from sophon_api import Options, SophonClient, RateLimiter, force_memory_release, RUN_MEMORY_HACK
 
 
 def update_config_ini_version(gamedir: pathlib.Path, version: str):
@@ -27,12 +27,13 @@ def remove_cached_files(tempdir: pathlib.Path):
     else:
         print(f"Temporary directory {tempdir} does not exist, skipping removal.")
 
-def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: InstallRequest, cancel_event: Optional[threading.Event] = None):
+def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: InstallRequest, cancel_event: Optional[threading.Event] = None, rate_limiter: Optional[RateLimiter] = None):
     progress = InstallProgressHandler(task_id, manager, tasks)
     progress.job_start()
 
     options = Options()
     options.gamedir = pathlib.Path(request.gamedir)
+    options.background = (request.priority == "background")
     options.do_install = True
     options.install_reltype = request.install_reltype
     options.game_type = request.game_type
@@ -45,6 +46,7 @@ def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], ta
 
     cli = SophonClient()
     cli.initialize(options)
+    cli.rate_limiter = rate_limiter
     cli.retrieve_API_keys()
 
     cli.load_manifest("game")
@@ -58,22 +60,6 @@ def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], ta
         download_categories=["game"]
     )
 
-    def download_file(v):
-        err_cnt = 0
-        err_logs = []
-        while err_cnt < 5:
-            try:
-                if cancel_event and cancel_event.is_set():
-                    progress.job_error("cancelled")
-                    raise Exception("Installation cancelled")
-                cli.download_game_file(v, install_progress_handler=progress, cancel_event=cancel_event)
-                break
-            except Exception as e:
-                err_cnt += 1
-                err_logs.append(str(e))
-        if err_cnt == 5:
-            raise Exception(f"Download file {v.name} failed after 3 attempts: {err_logs}")
-
     # Prioritize downloading essintial files for version & game recognition
     positive_substr = ['globalgamemanagers', 'pkg_version']
     negative_substr = ['/']
@@ -90,16 +76,14 @@ def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], ta
 
         return priority
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_CNT) as executor:
-        futures = [
-            executor.submit(download_file, v) for v in
-            sorted(
-                cli.di_chunks.manifest.files,
-                key = key_func
-            )
-        ]
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+    cli.download_game_files(
+        sorted(
+            cli.di_chunks.manifest.files,
+            key = key_func
+        ),
+        progress_handler=progress,
+        cancel_event=cancel_event
+    )
 
     cli.load_manifest("game")
     cli.update_config_ini_version()
@@ -111,14 +95,17 @@ def perform_install(manager: ConnectionManager, tasks: Dict[str, TaskStatus], ta
     if RUN_MEMORY_HACK:
         force_memory_release()
 
-def perform_repair(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: RepairRequest, cancel_event: Optional[threading.Event] = None):
+def perform_repair(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: RepairRequest, cancel_event: Optional[threading.Event] = None, rate_limiter: Optional[RateLimiter] = None):
     progress = RepairProgressHandler(task_id, manager, tasks)
     progress.job_start()
 
     options = Options()
     options.gamedir = pathlib.Path(request.gamedir)
+    options.background = (request.priority == "background")
     options.game_type = request.game_type
     options.repair_mode = request.repair_mode
+    if request.sample_percent is not None:
+        options.repair_sample_percent = request.sample_percent
     if request.tempdir:
         options.tempdir = pathlib.Path(request.tempdir)
     else:
@@ -128,8 +115,9 @@ def perform_repair(manager: ConnectionManager, tasks: Dict[str, TaskStatus], tas
 
     cli = SophonClient()
     cli.initialize(options)
-    cli.retrieve_API_keys()
+    cli.rate_limiter = rate_limiter
 
+    # Fetches the API keys and the manifest only if files need to be repaired
     cli.repair_by_category("game", repair_progress_handler=progress, cancel_event=cancel_event)
 
     del cli
@@ -139,12 +127,13 @@ def perform_repair(manager: ConnectionManager, tasks: Dict[str, TaskStatus], tas
     if RUN_MEMORY_HACK:
         force_memory_release()
 
-def perform_update(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: UpdateRequest, cancel_event: Optional[threading.Event] = None):
+def perform_update(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, request: UpdateRequest, cancel_event: Optional[threading.Event] = None, rate_limiter: Optional[RateLimiter] = None):
     progress = UpdateProgressHandler(task_id, manager, tasks)
     progress.job_start()
 
     options = Options()
     options.gamedir = pathlib.Path(request.gamedir)
+    options.background = (request.priority == "background")
     options.do_update = True
     options.game_type = request.game_type
     options.predownload = request.predownload
@@ -157,6 +146,7 @@ def perform_update(manager: ConnectionManager, tasks: Dict[str, TaskStatus], tas
 
     cli = SophonClient()
     cli.initialize(options)
+    cli.rate_limiter = rate_limiter
     cli.retrieve_API_keys()
     cli.load_manifest("game")
 
@@ -0,0 +1,5 @@
+"""
+	Unit tests of sophon_api. Run from the sophon_server directory:
+
+	python -m unittest discover -s tests -t .
+"""
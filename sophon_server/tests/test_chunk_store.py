@@ -0,0 +1,103 @@
+# Reference counting of the shared chunk store
+# SPDX-License-Identifier: MIT
+
+import pathlib
+import tempfile
+import unittest
+
+import manifest_pb2 # generated
+from sophon_api import ChunkStore
+
+
+def file_info(filename: str, md5: str, chunk_ids: list[str]) -> manifest_pb2.FileInfo:
+	v = manifest_pb2.FileInfo(filename=filename, md5=md5, size=100 * len(chunk_ids))
+	for chunk_id in chunk_ids:
+		v.chunks.add(chunk_id=chunk_id, compressed_size=10)
+	return v
+
+
+class ChunkStoreTest(unittest.TestCase):
+	def setUp(self):
+		self._tmp = tempfile.TemporaryDirectory()
+		self.store = ChunkStore(pathlib.Path(self._tmp.name) / "chunks")
+
+	def tearDown(self):
+		self._tmp.cleanup()
+
+	def store_chunk(self, chunk_id: str) -> pathlib.Path:
+		path = self.store.path(chunk_id)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(b"x")
+		return path
+
+	def test_shared_chunks(self):
+		a = file_info("a", "md5-a", ["c1", "c2"])
+		b = file_info("b", "md5-b", ["c2", "c3"])
+		saved, duplicates = self.store.plan([a, b])
+		self.assertEqual(saved, 10) # c2 once
+		self.assertEqual(duplicates, [])
+		self.assertFalse(self.store.is_shared("c1"))
+		self.assertTrue(self.store.is_shared("c2"))
+
+	def test_release_removes_after_last_reference(self):
+		a = file_info("a", "md5-a", ["c1", "c2"])
+		b = file_info("b", "md5-b", ["c2"])
+		self.store.plan([a, b])
+		c1 = self.store_chunk("c1")
+		c2 = self.store_chunk("c2")
+
+		self.store.release(a)
+		self.assertFalse(c1.exists())
+		self.assertTrue(c2.exists())
+		self.assertFalse(self.store.is_shared("c2"))
+
+		self.store.release(b)
+		self.assertFalse(c2.exists())
+		self.assertFalse(c2.parent.exists()) # empty subdirectory
+
+	def test_release_twice(self):
+		a = file_info("a", "md5-a", ["c1"])
+		b = file_info("b", "md5-b", ["c1"])
+		self.store.plan([a, b])
+		c1 = self.store_chunk("c1")
+		self.store.release(a)
+		self.store.release(a) # not planned anymore: must not drop the reference of `b`
+		self.assertTrue(c1.exists())
+		self.store.release(b)
+		self.assertFalse(c1.exists())
+
+	def test_plan_once_per_file(self):
+		a = file_info("a", "md5-a", ["c1"])
+		self.store.plan([a])
+		self.store.plan([a])
+		self.assertFalse(self.store.is_shared("c1"))
+
+	def test_duplicate_files(self):
+		a = file_info("a", "same", ["c1", "c2"])
+		b = file_info("b", "same", ["c1", "c2"])
+		saved, duplicates = self.store.plan([a, b])
+		self.assertEqual(saved, 20)
+		self.assertEqual([v.filename for v in duplicates], ["b"])
+		self.assertFalse(self.store.is_shared("c1")) # `b` is copied, not assembled
+
+	def test_files_not_fetched(self):
+		a = file_info("a", "same", ["c1"])
+		b = file_info("b", "same", ["c1"])
+		# `a` is installed already: `b` cannot be copied from a download of it
+		saved, duplicates = self.store.plan([a, b], lambda v: v.filename != "a")
+		self.assertEqual((saved, duplicates), (0, []))
+		self.assertFalse(self.store.is_shared("c1"))
+
+		c1 = self.store_chunk("c1")
+		self.store.release(b)
+		self.assertFalse(c1.exists())
+
+	def test_cached_ids(self):
+		self.assertEqual(self.store.cached_ids(), set())
+		self.store_chunk("ab01")
+		self.store_chunk("cd02")
+		self.assertEqual(self.store.cached_ids(), {"ab01", "cd02"})
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,51 @@
+# Extraction of patch sections
+# SPDX-License-Identifier: MIT
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import sophon_api
+from sophon_api import copy_file_section
+
+
+class CopyFileSectionTest(unittest.TestCase):
+	def setUp(self):
+		self.src = tempfile.TemporaryFile()
+		self.data = os.urandom(300 * 1024)
+		self.src.write(self.data)
+		self.src.flush()
+
+	def tearDown(self):
+		self.src.close()
+
+	def copy(self, offset: int, length: int) -> tuple[int, bytes]:
+		with tempfile.TemporaryFile() as dst:
+			copied = copy_file_section(self.src.fileno(), dst.fileno(), offset, length)
+			dst.seek(0)
+			return copied, dst.read()
+
+	def test_section(self):
+		self.assertEqual(self.copy(1000, 200 * 1024), (200 * 1024, self.data[1000:1000 + 200 * 1024]))
+
+	def test_truncated(self):
+		self.assertEqual(self.copy(len(self.data) - 10, 100), (10, self.data[-10:]))
+
+	def test_without_kernel_copy(self):
+		# As on macOS: neither copy_file_range nor sendfile to files
+		copy_file_range = getattr(os, "copy_file_range", None)
+		if copy_file_range is not None:
+			del os.copy_file_range
+		try:
+			with mock.patch.object(sophon_api.sys, "platform", "darwin"), \
+					mock.patch.object(os, "sendfile", side_effect=AssertionError, create=True):
+				self.test_section()
+				self.test_truncated()
+		finally:
+			if copy_file_range is not None:
+				os.copy_file_range = copy_file_range
+
+
+if __name__ == "__main__":
+	unittest.main()
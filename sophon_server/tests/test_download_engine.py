@@ -0,0 +1,77 @@
+# Bandwidth limits of the download engine
+# SPDX-License-Identifier: MIT
+
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pycurl
+from sophon_api import DownloadEngine, DownloadRequest, RateLimiter, _DownloadLane
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+	"""
+	Sends 800 bytes/s, below the low speed limit of unlimited transfers
+	"""
+	BLOCK = 200
+	BLOCKS = 16
+	INTERVAL = 0.25 # seconds
+	SIZE = BLOCK * BLOCKS
+
+	def do_GET(self):
+		self.send_response(200)
+		self.send_header("Content-Length", str(self.SIZE))
+		self.end_headers()
+		try:
+			for _ in range(self.BLOCKS):
+				self.wfile.write(bytes(self.BLOCK))
+				self.wfile.flush()
+				time.sleep(self.INTERVAL)
+		except ConnectionError:
+			pass # aborted by the client
+
+	def log_message(self, format, *args):
+		pass
+
+
+class RateChangeTest(unittest.TestCase):
+	def setUp(self):
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.url = f"http://127.0.0.1:{self.server.server_address[1]}/blob"
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def fetch(self, limiter: RateLimiter, rate_mid_transfer: int) -> DownloadRequest:
+		started = threading.Event()
+		def on_data(data: bytes):
+			started.set()
+
+		with mock.patch.object(_DownloadLane, "LOW_SPEED_TIME", 1):
+			engine = DownloadEngine(2)
+			req = engine.submit(DownloadRequest(self.url, on_data, limiters=[limiter]))
+			self.assertTrue(started.wait(5))
+			limiter.set_rate(rate_mid_transfer)
+			try:
+				req.wait()
+			except pycurl.error:
+				pass
+		return req
+
+	def test_unlimited_slow_transfer_is_aborted(self):
+		req = self.fetch(RateLimiter(0), 0)
+		self.assertEqual(req.error[0], pycurl.E_OPERATION_TIMEDOUT)
+
+	def test_limit_set_mid_transfer(self):
+		# Limited transfers may be slow: the low speed limit of running transfers follows
+		req = self.fetch(RateLimiter(0), 10 * 1024 * 1024)
+		self.assertIsNone(req.error)
+		self.assertEqual(req.bytes_received, SlowHandler.SIZE)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,92 @@
+# Whole-file MD5 of files assembled from chunks
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+
+from sophon_api import IncrementalMD5
+
+
+class IncrementalMD5Test(unittest.TestCase):
+	CHUNK = 4096
+
+	def setUp(self):
+		self.data = random.Random(1).randbytes(5 * self.CHUNK + 123)
+		self.expected = hashlib.md5(self.data).hexdigest()
+		self.fd, self.path = tempfile.mkstemp()
+
+	def tearDown(self):
+		os.close(self.fd)
+		os.unlink(self.path)
+
+	def chunks(self):
+		return [(offset, min(self.CHUNK, len(self.data) - offset))
+			for offset in range(0, len(self.data), self.CHUNK)]
+
+	def write(self, md5: IncrementalMD5, offset: int, length: int):
+		"""
+		Writes one chunk like `PositionalWriter` and marks it complete
+		"""
+		data = self.data[offset:offset + length]
+		os.pwrite(self.fd, data, offset)
+		hasher = md5.begin(offset)
+		if hasher is not None:
+			hasher.update(data)
+		md5.complete(offset, length, hasher)
+
+	def test_in_order(self):
+		md5 = IncrementalMD5(self.fd)
+		for offset, length in self.chunks():
+			self.write(md5, offset, length)
+		self.assertEqual(md5.hexdigest(len(self.data)), self.expected)
+
+	def test_out_of_order(self):
+		md5 = IncrementalMD5(self.fd)
+		chunks = self.chunks()
+		random.Random(2).shuffle(chunks)
+		for offset, length in chunks:
+			self.write(md5, offset, length)
+		self.assertEqual(md5.hexdigest(len(self.data)), self.expected)
+
+	def test_failed_attempt_is_discarded(self):
+		md5 = IncrementalMD5(self.fd)
+		offset, length = self.chunks()[0]
+		hasher = md5.begin(offset)
+		hasher.update(b"corrupt data")
+		# Retry: the first attempt is never completed
+		self.write(md5, offset, length)
+		for offset, length in self.chunks()[1:]:
+			self.write(md5, offset, length)
+		self.assertEqual(md5.hexdigest(len(self.data)), self.expected)
+
+	def test_resume_with_chunks_on_disk(self):
+		# A previous run wrote every other chunk. They are completed without hasher.
+		os.pwrite(self.fd, self.data, 0)
+		md5 = IncrementalMD5(self.fd)
+		chunks = self.chunks()
+		for offset, length in chunks[1::2]:
+			md5.complete(offset, length)
+		self.assertIsNone(md5.hexdigest(len(self.data)))
+		for offset, length in chunks[0::2]:
+			self.write(md5, offset, length)
+		self.assertEqual(md5.hexdigest(len(self.data)), self.expected)
+
+	def test_incomplete(self):
+		md5 = IncrementalMD5(self.fd)
+		for offset, length in self.chunks()[:-1]:
+			self.write(md5, offset, length)
+		self.assertIsNone(md5.hexdigest(len(self.data)))
+
+	def test_gap(self):
+		md5 = IncrementalMD5(self.fd)
+		for offset, length in self.chunks()[1:]:
+			self.write(md5, offset, length)
+		self.assertEqual(md5.position, 0)
+		self.assertIsNone(md5.hexdigest(len(self.data)))
+
+
+if __name__ == "__main__":
+	unittest.main()
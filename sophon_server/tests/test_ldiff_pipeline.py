@@ -0,0 +1,100 @@
+# Grouping of files that share an ldiff file
+# SPDX-License-Identifier: MIT
+
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+
+import manifest_ldiff_pb2 # generated
+import sophon_api
+from sophon_api import SophonClient, UpdatePlan, VerifyIndex
+
+
+class FakeClient(SophonClient):
+	"""
+	Runs `apply_or_prepare_ldiff_files` without network and patch tools.
+	Records the order of patches and removals.
+	"""
+	def __init__(self, patch_ids: dict[str, str], fail: set[str] = frozenset()):
+		super().__init__()
+		self.patch_ids = patch_ids # filename -> patch_id
+		self.fail = fail # filenames whose patch fails
+		self.events: list[tuple[str, str]] = []
+		self.downloads: list[tuple[str, list]] = []
+		self._events_lock = threading.Lock()
+		self.di_diffs.manifest = manifest_ldiff_pb2.DiffManifest()
+		for filename in patch_ids:
+			self.di_diffs.manifest.files.add(filename=filename)
+
+	def _event(self, kind: str, name: str):
+		with self._events_lock:
+			self.events.append((kind, name))
+
+	def plan_update(self) -> UpdatePlan:
+		return UpdatePlan(1.0) # no entries: everything by ldiff
+
+	def get_ldiff_patchinfo(self, v):
+		return manifest_ldiff_pb2.PatchInfo(patch_id=self.patch_ids[v.filename],
+			patch_offset=len(v.filename), patch_length=1)
+
+	def _check_ldiff_file(self, v, progress_handler = None):
+		return self.get_ldiff_patchinfo(v)
+
+	def _download_ldiff_blob(self, ldiff_dir, v, pinfo, sections, progress_handler = None):
+		self.downloads.append((pinfo.patch_id, sections))
+		return pinfo.patch_id
+
+	def _apply_ldiff_file(self, ldiff_dir, v, progress_handler = None):
+		if v.filename == "slow":
+			time.sleep(0.2) # finishes after the other users of its ldiff file
+		if v.filename in self.fail:
+			raise RuntimeError("patch failed")
+		self._event("patch", v.filename)
+
+	def _remove_ldiff_blob(self, ldiff_dir, ldiffname):
+		self._event("remove", ldiffname)
+
+
+class LdiffPipelineTest(unittest.TestCase):
+	def setUp(self):
+		self._tmp = tempfile.TemporaryDirectory()
+		self._gamedir = sophon_api.OPT.gamedir
+		sophon_api.OPT.gamedir = pathlib.Path(self._tmp.name)
+
+	def tearDown(self):
+		sophon_api.OPT.gamedir = self._gamedir
+		self._tmp.cleanup()
+
+	def run_update(self, cli: FakeClient):
+		cli.verify_index = VerifyIndex(pathlib.Path(self._tmp.name) / "verify-index.jsonl")
+		cli.apply_or_prepare_ldiff_files()
+
+	def test_download_once_per_patch_id(self):
+		cli = FakeClient({ "a": "P", "b": "P", "c": "Q" })
+		self.run_update(cli)
+		self.assertEqual(sorted(patch_id for patch_id, _ in cli.downloads), ["P", "Q"])
+		sections = dict(cli.downloads)
+		self.assertEqual(sorted(sections["P"]), [(1, 1), (1, 1)])
+
+	def test_removed_after_last_consumer(self):
+		cli = FakeClient({ "slow": "P", "a": "P", "b": "P", "c": "Q" })
+		self.run_update(cli)
+		removals = [name for kind, name in cli.events if kind == "remove"]
+		self.assertEqual(sorted(removals), ["P", "Q"])
+		# Every file patched with "P" before "P" is gone
+		removed_at = cli.events.index(("remove", "P"))
+		for filename in ("slow", "a", "b"):
+			self.assertLess(cli.events.index(("patch", filename)), removed_at)
+
+	def test_kept_if_a_patch_fails(self):
+		cli = FakeClient({ "a": "P", "b": "P", "c": "Q" }, fail={"b"})
+		with self.assertRaises(RuntimeError):
+			self.run_update(cli)
+		# "P" is needed to retry "b"
+		self.assertNotIn(("remove", "P"), cli.events)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,77 @@
+# Range bookkeeping of partially downloaded ldiff files
+# SPDX-License-Identifier: MIT
+
+import pathlib
+import tempfile
+import unittest
+
+from sophon_api import LdiffSections, coalesce_ranges
+
+
+class CoalesceRangesTest(unittest.TestCase):
+	def test_sorts_and_keeps_separate_ranges(self):
+		self.assertEqual(coalesce_ranges([(100, 10), (0, 10)]), [(0, 10), (100, 10)])
+
+	def test_merges_overlapping_and_adjacent(self):
+		self.assertEqual(coalesce_ranges([(0, 10), (5, 10), (15, 5)]), [(0, 20)])
+
+	def test_contained_range_does_not_shrink(self):
+		self.assertEqual(coalesce_ranges([(0, 100), (10, 5)]), [(0, 100)])
+
+	def test_max_gap(self):
+		ranges = [(0, 10), (15, 10), (40, 10)]
+		self.assertEqual(coalesce_ranges(ranges), ranges)
+		self.assertEqual(coalesce_ranges(ranges, max_gap=5), [(0, 25), (40, 10)])
+		self.assertEqual(coalesce_ranges(ranges, max_gap=15), [(0, 50)])
+
+	def test_empty(self):
+		self.assertEqual(coalesce_ranges([]), [])
+
+
+class LdiffSectionsTest(unittest.TestCase):
+	def setUp(self):
+		self._tmp = tempfile.TemporaryDirectory()
+		self.ldiffname = pathlib.Path(self._tmp.name) / "0123456789abcdef"
+
+	def tearDown(self):
+		self._tmp.cleanup()
+
+	def test_new_file_has_no_sidecar(self):
+		sections = LdiffSections(self.ldiffname)
+		self.assertFalse(sections.exists())
+		self.assertFalse(sections.covers(0, 1))
+
+	def test_create_empty_sidecar(self):
+		sections = LdiffSections(self.ldiffname)
+		sections.add(0, 0)
+		self.assertTrue(sections.exists())
+		self.assertEqual(LdiffSections(self.ldiffname).ranges, [])
+
+	def test_covers(self):
+		sections = LdiffSections(self.ldiffname)
+		sections.add(100, 50)
+		sections.add(150, 50) # adjacent: merged
+		sections.add(300, 10)
+		self.assertEqual(sections.ranges, [(100, 100), (300, 10)])
+		self.assertTrue(sections.covers(100, 100))
+		self.assertTrue(sections.covers(120, 60))
+		self.assertFalse(sections.covers(90, 20))
+		self.assertFalse(sections.covers(190, 120)) # spans the hole
+
+	def test_reload(self):
+		LdiffSections(self.ldiffname).add(10, 20)
+		sections = LdiffSections(self.ldiffname)
+		sections.add(0, 10)
+		self.assertEqual(LdiffSections(self.ldiffname).ranges, [(0, 30)])
+
+	def test_remove(self):
+		sections = LdiffSections(self.ldiffname)
+		sections.add(0, 10)
+		sections.remove()
+		self.assertFalse(sections.exists())
+		self.assertEqual(sections.ranges, [])
+		self.assertEqual(LdiffSections(self.ldiffname).ranges, [])
+
+
+if __name__ == "__main__":
+	unittest.main()
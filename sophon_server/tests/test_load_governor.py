@@ -0,0 +1,66 @@
+# Background worker limit
+# SPDX-License-Identifier: MIT
+
+import threading
+import unittest
+from unittest import mock
+
+from sophon_api import LoadGovernor
+
+
+class LoadGovernorTest(unittest.TestCase):
+	def make_governor(self, busy_share: float) -> LoadGovernor:
+		"""
+		Returns a governor that sees other processes use `busy_share` of all cores.
+		Every call of `_system_cpu_times` advances the clock by one second of 4 cores.
+		"""
+		clock = { "busy": 0.0, "total": 0.0 }
+		def system_cpu_times():
+			clock["busy"] += 4 * busy_share
+			clock["total"] += 4
+			return clock["busy"], clock["total"]
+
+		patches = [
+			mock.patch.object(LoadGovernor, "_system_cpu_times", staticmethod(system_cpu_times)),
+			mock.patch.object(LoadGovernor, "_process_cpu_time", lambda self: 0.0),
+			mock.patch.object(LoadGovernor, "_disk_busy_time", staticmethod(lambda: None)),
+		]
+		for p in patches:
+			p.start()
+			self.addCleanup(p.stop)
+		return LoadGovernor(1, 16, 8)
+
+	def adjust_from_threads(self, governor: LoadGovernor, count: int):
+		"""
+		Runs one window per thread, like the pool workers that call `acquire()`
+		"""
+		for _ in range(count):
+			governor._window_start -= LoadGovernor.INTERVAL
+			t = threading.Thread(target=lambda: governor._adjust())
+			t.start()
+			t.join()
+
+	def test_busy_system_from_many_threads(self):
+		governor = self.make_governor(0.9)
+		self.adjust_from_threads(governor, 4)
+		self.assertEqual(governor.limit, 1)
+
+	def test_idle_system_from_many_threads(self):
+		governor = self.make_governor(0.05)
+		self.adjust_from_threads(governor, 4)
+		self.assertEqual(governor.limit, 12)
+
+	def test_own_cpu_time_is_not_counted(self):
+		governor = self.make_governor(0.9)
+		own = { "time": 0.0 }
+		def process_cpu_time(self):
+			own["time"] += 4 * 0.85 # most of the load is ours
+			return own["time"]
+		with mock.patch.object(LoadGovernor, "_process_cpu_time", process_cpu_time):
+			governor._own_time = process_cpu_time(governor)
+			self.adjust_from_threads(governor, 2)
+		self.assertEqual(governor.limit, 10)
+
+
+if __name__ == "__main__":
+	unittest.main()
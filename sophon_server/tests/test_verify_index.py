@@ -0,0 +1,88 @@
+# Persistent index of verified game files
+# SPDX-License-Identifier: MIT
+
+import pathlib
+import tempfile
+import unittest
+
+import sophon_api
+from sophon_api import VerifyIndex
+
+
+class VerifyIndexTest(unittest.TestCase):
+	def setUp(self):
+		self._tmp = tempfile.TemporaryDirectory()
+		root = pathlib.Path(self._tmp.name)
+		self._gamedir = sophon_api.OPT.gamedir
+		sophon_api.OPT.gamedir = root / "game"
+		sophon_api.OPT.gamedir.mkdir()
+		self.path = root / "verify-index.jsonl"
+		(sophon_api.OPT.gamedir / "a.bin").write_bytes(b"aaaa")
+		(sophon_api.OPT.gamedir / "b.bin").write_bytes(b"bbbb")
+
+	def tearDown(self):
+		sophon_api.OPT.gamedir = self._gamedir
+		self._tmp.cleanup()
+
+	def test_missing_file(self):
+		index = VerifyIndex(self.path)
+		self.assertIsNone(index.lookup("a.bin"))
+
+	def test_save_and_load(self):
+		index = VerifyIndex(self.path)
+		index.record("a.bin", "md5-a", "1.0.0")
+		self.assertEqual(index.lookup("a.bin"), "md5-a")
+		self.assertFalse(self.path.exists()) # not flushed yet
+		index.flush()
+
+		index = VerifyIndex(self.path)
+		self.assertEqual(index.lookup("a.bin"), "md5-a")
+		self.assertIsNone(index.lookup("b.bin"))
+
+	def test_modified_file(self):
+		index = VerifyIndex(self.path)
+		index.record("a.bin", "md5-a")
+		(sophon_api.OPT.gamedir / "a.bin").write_bytes(b"changed")
+		self.assertIsNone(index.lookup("a.bin"))
+
+	def test_last_entry_wins(self):
+		index = VerifyIndex(self.path)
+		index.record("a.bin", "old")
+		index.flush()
+		index.record("a.bin", "new")
+		index.flush()
+		self.assertEqual(VerifyIndex(self.path).lookup("a.bin"), "new")
+
+	def test_partial_line_is_ignored(self):
+		index = VerifyIndex(self.path)
+		index.record("a.bin", "md5-a")
+		index.record("b.bin", "md5-b")
+		index.flush()
+		with self.path.open("a", encoding="utf-8") as fh:
+			fh.write('{"filename": "b.bin", "st') # interrupted write
+
+		index = VerifyIndex(self.path)
+		self.assertEqual(index.lookup("a.bin"), "md5-a")
+		self.assertEqual(index.lookup("b.bin"), "md5-b")
+
+	def test_compaction(self):
+		index = VerifyIndex(self.path)
+		for i in range(2 * VerifyIndex.FLUSH_INTERVAL + 1):
+			index.record("a.bin", f"md5-{i}")
+		index.flush()
+		# Rewritten once most lines were outdated
+		self.assertLess(len(self.path.read_text().splitlines()), VerifyIndex.FLUSH_INTERVAL + 1)
+		self.assertEqual(VerifyIndex(self.path).lookup("a.bin"), f"md5-{2 * VerifyIndex.FLUSH_INTERVAL}")
+
+	def test_dry_run_records_nothing(self):
+		sophon_api.OPT.dry_run = True
+		try:
+			index = VerifyIndex(self.path)
+			index.record("a.bin", "md5-a")
+		finally:
+			del sophon_api.OPT.dry_run
+		self.assertIsNone(index.lookup("a.bin"))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -79,7 +79,7 @@ class ConnectionManager:
         if self._worker_thread and self._worker_thread.is_alive():
             self._worker_thread.join(timeout=5.0)
 
-def run_task_in_thread(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, operation_func, *args):
+def run_task_in_thread(manager: ConnectionManager, tasks: Dict[str, TaskStatus], task_id: str, operation_func, *args, on_finished=None):
     def task_runner():
         try:
             tasks[task_id].status = "running"
@@ -102,6 +102,9 @@ def run_task_in_thread(manager: ConnectionManager, tasks: Dict[str, TaskStatus],
 
             tasks[task_id].status = "failed"
             tasks[task_id].error = str(e)
+        finally:
+            if on_finished:
+                on_finished()
 
     thread = threading.Thread(target=task_runner, daemon=True)
     thread.start()